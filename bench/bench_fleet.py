@@ -0,0 +1,198 @@
+# Scaling of fleet mode: many cars, one controller-side aggregator (Python 3)
+#
+# Two parts, for each number of cars:
+#   aggregate - fleet.fleet_aggregator on its own: the cost per message, and of computing the combined view, with
+#               the array module and (if installed) numpy, to show that the cost per message doesn't grow with the fleet
+#   mqtt      - simulated cars, each publishing its position (binary /car/XY) and a telemetry delta at a fixed rate
+#               to the broker stand-in (wifi-py-rpi/mqttbroker.py) on loopback, fanned in to an aggregator fed by a
+#               paho client, as in controller.py: the fan-in latency (car's timestamp to aggregated), the messages
+#               offered and aggregated per second, and telemetry deltas missed
+# Results are printed (or written) as JSON, so that they can be compared from one run to the next.
+#
+#   python bench_fleet.py [--quick] [--output results.json] [--cars 1,8,32,128] [--rate 10]
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import platform
+import threading
+
+bench_dir = os.path.dirname (os.path.abspath (__file__))
+repo_dir = os.path.dirname (bench_dir)
+sys.path.insert (0, os.path.join (repo_dir, 'wifi-py-rpi'))
+
+import paho.mqtt.client as mqtt
+
+import fleet
+import xycodec
+import mqttbroker
+
+from ticktock import qClock
+from bench_mqtt import bench_client, paho_client, summarise
+
+def car_names (cars):
+    return ['car%03d' % i for i in range (0, cars)]
+
+def bench_aggregate (cars, messages, bNumpy):
+    # feeds the aggregator directly, round robin over the cars, alternating position and telemetry
+    aggregator = fleet.fleet_aggregator (bNumpy=bNumpy)
+    inputs = []
+    for name in car_names (cars):
+        inputs.append ((fleet.fleet_topic (name, 'car/XY'), xycodec.xy_encode (0.25, -0.5, 1)))
+        delta = json.dumps ({ 'position': [0.25, -0.5], 'seq': 1, 't': time.time () }).encode ('ascii')
+        inputs.append ((fleet.fleet_topic (name, 'car/telemetry'), delta))
+    for topic, payload in inputs: # the first message from each car allocates its slot
+        aggregator.message (topic, payload)
+
+    n = len (inputs)
+    now = time.time ()
+    t0 = qClock ()
+    for i in range (0, messages):
+        topic, payload = inputs[i % n]
+        aggregator.message (topic, payload, now)
+    per_message = (qClock () - t0) / messages
+
+    repeats = 100
+    t0 = qClock ()
+    for i in range (0, repeats):
+        aggregator.view (now)
+    per_view = (qClock () - t0) / repeats
+    return { 'cars': cars, 'numpy': aggregator.bNumpy, 'message_us': 1e6 * per_message, 'view_us': 1e6 * per_view,
+             'bytes': aggregator.counters ()['bytes'] }
+
+class bench_car (object):
+    # Publishes what a car in a fleet does, with no controller behind it
+
+    def __init__ (self, name, rate):
+        self.name = name
+        self.rate = rate
+        self.client = bench_client ('car-' + name, lambda topic, payload, t: None)
+        self.topic_xy = fleet.fleet_topic (name, 'car/XY').encode ('utf-8')
+        self.topic_telemetry = fleet.fleet_topic (name, 'car/telemetry').encode ('utf-8')
+        self.sent = 0
+        return
+
+    async def run (self, t_start, t_end, offset):
+        period = 1.0 / self.rate
+        t_next = t_start + offset * period
+        k = 0
+        writer = self.client.writer
+        while True:
+            delay = t_next - time.time ()
+            if delay > 0:
+                await asyncio.sleep (delay)
+            now = time.time ()
+            if now >= t_end:
+                break
+            k += 1
+            x = (k % 2048) / 1024.0 - 1.0
+            writer.write (mqttbroker.mqtt_publish_packet (self.topic_xy, xycodec.xy_encode (x, 0.0, k, now)))
+            delta = json.dumps ({ 'position': [x, 0.0], 'seq': k, 't': now })
+            writer.write (mqttbroker.mqtt_publish_packet (self.topic_telemetry, delta.encode ('ascii')))
+            self.sent += 2
+            t_next += period
+            if t_next < now:
+                t_next = now
+        return
+
+async def bench_cars (port, cars, rate, duration):
+    fleet_cars = [bench_car (name, rate) for name in car_names (cars)]
+    for car in fleet_cars:
+        await car.client.connect ('127.0.0.1', port, [])
+    t_start = time.time () + 0.1
+    t_end = t_start + duration
+    await asyncio.gather (*[fleet_cars[i].run (t_start, t_end, float (i) / cars) for i in range (0, cars)])
+    elapsed = time.time () - t_start
+    await asyncio.sleep (0.5) # for the last messages to be aggregated
+    for car in fleet_cars:
+        await car.client.close ()
+    return sum ([car.sent for car in fleet_cars]), elapsed
+
+def bench_mqtt (cars, rate, duration):
+    broker = mqttbroker.mqtt_broker ()
+    port = broker.start_in_thread ('127.0.0.1', 0)
+
+    aggregator = fleet.fleet_aggregator ()
+    fan_in = []
+    busy = [0.0]
+    lock = threading.Lock ()
+    subscribed = threading.Event ()
+
+    def on_connect (client, userdata, flags, rc):
+        client.subscribe ([(fleet.fleet_topic (fleet.fleet_any, 'car/XY'), 0),
+                           (fleet.fleet_topic (fleet.fleet_any, 'car/telemetry'), 0)])
+        return
+
+    def on_subscribe (client, userdata, mid, granted_qos):
+        subscribed.set ()
+        return
+
+    def on_message (client, userdata, msg):
+        t0 = qClock ()
+        now = time.time ()
+        aggregator.message (msg.topic, msg.payload, now)
+        with lock:
+            busy[0] += qClock () - t0
+            slot = aggregator.routes[msg.topic][0]
+            fan_in.append (now - aggregator.t_position[slot])
+        return
+
+    client = paho_client (client_id='controller', clean_session=True, protocol=mqtt.MQTTv31)
+    client.on_connect = on_connect
+    client.on_subscribe = on_subscribe
+    client.on_message = on_message
+    client.connect ('127.0.0.1', port, 60)
+    client.loop_start ()
+    subscribed.wait (10)
+
+    sent, elapsed = asyncio.run (bench_cars (port, cars, rate, duration))
+    client.disconnect ()
+    client.loop_stop ()
+    broker.stop ()
+
+    counters = aggregator.counters ()
+    view = aggregator.view ()
+    return { 'cars': cars, 'rate': rate, 'duration': elapsed, 'sent': sent, 'aggregated': counters['received'],
+             'throughput': { 'offered': sent / elapsed, 'aggregated': counters['received'] / elapsed },
+             'aggregate_us': 1e6 * busy[0] / max (1, counters['received']),
+             'fan_in': summarise (fan_in), 'missed': view['missed'], 'broker': broker.counters () }
+
+def parse_list (text, kind):
+    return [kind (value) for value in text.split (',') if value]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser (description='Benchmark the fleet aggregator with simulated cars.')
+    parser.add_argument ('--quick', action='store_true', help='fewer cars, shorter runs')
+    parser.add_argument ('--output', default=None, help='write the JSON results to this file')
+    parser.add_argument ('--cars', default=None, help='numbers of cars, comma separated')
+    parser.add_argument ('--rate', type=float, default=10.0, help='positions (and telemetry deltas) per second per car')
+    parser.add_argument ('--duration', type=float, default=None, help='seconds per MQTT run')
+    args = parser.parse_args ()
+
+    if args.quick:
+        cars, duration, messages = [1, 8, 32], 1.0, 20000
+    else:
+        cars, duration, messages = [1, 8, 32, 128, 512], 5.0, 200000
+    if args.cars:
+        cars = parse_list (args.cars, int)
+    if args.duration:
+        duration = args.duration
+
+    results = { 'python': platform.python_version (), 'machine': platform.machine (), 'time': time.time (),
+                'quick': args.quick, 'aggregate': [], 'mqtt': [] }
+    for n in cars:
+        results['aggregate'].append (bench_aggregate (n, messages, False))
+        if fleet.numpy is not None:
+            results['aggregate'].append (bench_aggregate (n, messages, True))
+    for n in cars:
+        results['mqtt'].append (bench_mqtt (n, args.rate, duration))
+
+    text = json.dumps (results, indent=2, sort_keys=True)
+    if args.output is None:
+        print (text)
+    else:
+        with open (args.output, 'w') as f:
+            f.write (text + '\n')
@@ -0,0 +1,298 @@
+# End-to-end latency through MQTT: dashboards -> broker -> car.py -> broker -> dashboards (Python 3)
+#
+# Starts the broker stand-in (wifi-py-rpi/mqttbroker.py) on loopback, runs the real car_controller from
+# wifi-py-rpi/car.py with a paho client, and simulates N dashboards, each publishing binary /dash/XY at a fixed rate and
+# listening for the car's /car/XY. For each number of dashboards and rate, reports latency per hop:
+#   broker     - a dashboard publishing a position, to an observer subscribed to /dash/XY receiving it
+#   car        - publishing, to the car stamping /car/XY with that position (including the wait for its next tock)
+#   return     - the car stamping /car/XY, to the dashboards receiving it
+#   round_trip - publishing, to the dashboard receiving its own position back on /car/XY
+# and throughput: the messages offered, passed on by the broker and handled by the car per second. The highest rate the
+# car handled is reported as its ceiling. The car only echoes the latest position at each tock, so round trips are
+# measured for the positions that were echoed. No physical network is involved, so this is the floor for a real
+# deployment. Results are printed (or written) as JSON, so that they can be compared from one run to the next.
+#
+#   python bench_mqtt.py [--quick] [--output results.json] [--dashboards 1,4,16] [--rates 10,50,200]
+
+import os
+import sys
+import json
+import time
+import struct
+import asyncio
+import argparse
+import platform
+import threading
+import contextlib
+
+bench_dir = os.path.dirname (os.path.abspath (__file__))
+repo_dir = os.path.dirname (bench_dir)
+sys.path.insert (0, os.path.join (repo_dir, 'wifi-py-rpi'))
+
+import paho.mqtt
+import paho.mqtt.client as mqtt
+
+import car as car_module
+import xycodec
+import mqttbroker
+
+from mqttbroker import mqtt_packet, mqtt_publish_packet, mqtt_read_packet, mqtt_reader
+
+def summarise (values):
+    if not values:
+        return { 'count': 0, 'mean': 0.0, 'p50': 0.0, 'p90': 0.0, 'p99': 0.0, 'max': 0.0 }
+    ordered = sorted (values)
+    n = len (ordered)
+    def percentile (p):
+        return ordered[min (n - 1, int (p / 100.0 * n))]
+    return { 'count': n, 'mean': sum (ordered) / n, 'p50': percentile (50), 'p90': percentile (90),
+             'p99': percentile (99), 'max': ordered[-1] }
+
+def mqtt_string (s):
+    if not isinstance (s, bytes):
+        s = s.encode ('utf-8')
+    return struct.pack ('!H', len (s)) + s
+
+def paho_client (**kwargs):
+    if hasattr (mqtt, 'CallbackAPIVersion'): # paho-mqtt 2
+        return mqtt.Client (mqtt.CallbackAPIVersion.VERSION1, **kwargs)
+    return mqtt.Client (**kwargs)
+
+class bench_client (object):
+    # A bare MQTT client on asyncio, so that many dashboards can share one thread without the load generator being
+    # the bottleneck
+
+    def __init__ (self, client_id, received):
+        self.client_id = client_id
+        self.received = received # received (topic, payload, t)
+        self.reader = None
+        self.writer = None
+        self.task = None
+        return
+
+    async def connect (self, host, port, topic_filters):
+        self.reader, self.writer = await asyncio.open_connection (host, port)
+        body = mqtt_string ('MQTT') + b'\x04\x02' + struct.pack ('!H', 0) + mqtt_string (self.client_id)
+        self.writer.write (mqtt_packet (mqttbroker.mqtt_CONNECT, 0, body))
+        await mqtt_read_packet (self.reader) # CONNACK
+        if topic_filters:
+            body = struct.pack ('!H', 1)
+            for topic_filter in topic_filters:
+                body += mqtt_string (topic_filter) + b'\x00'
+            self.writer.write (mqtt_packet (mqttbroker.mqtt_SUBSCRIBE, 2, body))
+            await mqtt_read_packet (self.reader) # SUBACK
+        self.task = asyncio.ensure_future (self.listen ())
+        return
+
+    async def listen (self):
+        try:
+            while True:
+                packet_type, flags, body = await mqtt_read_packet (self.reader)
+                if packet_type == mqttbroker.mqtt_PUBLISH:
+                    t = time.time ()
+                    r = mqtt_reader (body)
+                    topic = r.string ()
+                    self.received (topic, r.rest (), t)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        return
+
+    def publish (self, topic, payload):
+        self.writer.write (mqtt_publish_packet (topic.encode ('utf-8'), payload))
+        return
+
+    async def close (self):
+        self.writer.write (mqtt_packet (mqttbroker.mqtt_DISCONNECT, 0, b''))
+        self.writer.close ()
+        if self.task is not None:
+            await asyncio.gather (self.task, return_exceptions=True)
+        return
+
+class bench_dashboard (object):
+    # Publishes positions whose values are exact in float32, so that it can recognise them when the car echoes them;
+    # y identifies the dashboard
+
+    def __init__ (self, index, rate):
+        self.index = index
+        self.rate = rate
+        self.y = (index % 2048) / 1024.0 - 1.0
+        self.client = bench_client ('bench-dash-' + str (index), self.received)
+        self.sent = {} # x -> time sent, for the positions not yet echoed
+        self.count = 0
+        self.echoed = 0
+        self.car_hop = []
+        self.return_hop = []
+        self.round_trip = []
+        self.car_announced = None
+        return
+
+    def received (self, topic, payload, t):
+        if topic == car_module.addr_car_encoding:
+            if self.car_announced is not None:
+                self.car_announced.set ()
+            return
+        if topic != car_module.addr_car_xy:
+            return
+        try:
+            x, y, sequence, t_car = xycodec.xy_decode (payload)
+        except ValueError:
+            return
+        if t_car is None: # text, from before the car heard our announcement
+            return
+        self.return_hop.append (t - t_car)
+        if y != self.y:
+            return
+        t_sent = self.sent.pop (x, None)
+        if t_sent is not None:
+            self.echoed += 1
+            self.car_hop.append (t_car - t_sent)
+            self.round_trip.append (t - t_sent)
+        return
+
+    async def run (self, t_start, t_end):
+        period = 1.0 / self.rate
+        t_next = t_start + (period * self.index / 64.0) % period # spread the dashboards out a little
+        k = 0
+        while True:
+            delay = t_next - time.time ()
+            if delay > 0:
+                await asyncio.sleep (delay)
+            now = time.time ()
+            if now >= t_end:
+                break
+            x = (k % 2048) / 1024.0 - 1.0
+            k += 1
+            self.sent[x] = now
+            self.client.publish (car_module.addr_dash_xy, xycodec.xy_encode (x, self.y, k, now))
+            self.count += 1
+            t_next += period
+            if t_next < now: # fell behind; don't try to catch up in a burst
+                t_next = now
+        return
+
+class bench_observer (object):
+    # Subscribed to /dash/XY, for the broker hop
+
+    def __init__ (self):
+        self.broker_hop = []
+        self.client = bench_client ('bench-observer', self.received)
+        return
+
+    def received (self, topic, payload, t):
+        try:
+            x, y, sequence, t_dash = xycodec.xy_decode (payload)
+        except ValueError:
+            return
+        if t_dash is not None:
+            self.broker_hop.append (t - t_dash)
+        return
+
+async def bench_load (port, dashboards, rate, duration):
+    observer = bench_observer ()
+    await observer.client.connect ('127.0.0.1', port, [car_module.addr_dash_xy])
+
+    dashes = []
+    for index in range (0, dashboards):
+        dash = bench_dashboard (index, rate)
+        dashes.append (dash)
+    first = dashes[0]
+    first.car_announced = asyncio.Event ()
+    for dash in dashes:
+        await dash.client.connect ('127.0.0.1', port, [car_module.addr_car_encoding, car_module.addr_car_xy])
+
+    # the car's retained announcement comes after its subscriptions, so after this it hears us
+    await asyncio.wait_for (first.car_announced.wait (), 10)
+    first.client.publish (car_module.addr_dash_encoding, xycodec.xy_encodings.encode ('ascii'))
+    await asyncio.sleep (0.2)
+
+    t_start = time.time ()
+    t_end = t_start + duration
+    await asyncio.gather (*[dash.run (t_start, t_end) for dash in dashes])
+    elapsed = time.time () - t_start
+    await asyncio.sleep (0.5) # for the last echoes
+
+    for dash in dashes:
+        await dash.client.close ()
+    await observer.client.close ()
+    return dashes, observer, elapsed
+
+def bench_run (dashboards, rate, duration):
+    broker = mqttbroker.mqtt_broker ()
+    port = broker.start_in_thread ('127.0.0.1', 0)
+
+    with open (os.devnull, 'w') as devnull, contextlib.redirect_stdout (devnull): # car.py prints every tock and event
+        car_module.xy_encoding = 'auto' # the simulated dashboards all announce binary
+        car = car_module.car_controller ()
+        client = paho_client (client_id='car', clean_session=True, userdata=car, protocol=mqtt.MQTTv31)
+        client.on_connect = car_module.on_connect
+        client.on_message = car_module.on_message
+        car_module.client = client
+        client.connect ('127.0.0.1', port, 60)
+        car.outbound.start (client) # drives the client's network loop, as in car.py
+        thread = threading.Thread (target=car.run, name='car')
+        thread.start ()
+
+        try:
+            dashes, observer, elapsed = asyncio.run (bench_load (port, dashboards, rate, duration))
+        finally:
+            car.stop ()
+            thread.join ()
+            car.outbound.stop ()
+            client.disconnect ()
+        stats = car.stats ()
+    broker.stop ()
+
+    sent = sum ([dash.count for dash in dashes])
+    car_events = stats['run']['event']['count']
+    result = { 'dashboards': dashboards, 'rate': rate, 'duration': elapsed, 'sent': sent,
+               'echoed': sum ([dash.echoed for dash in dashes]),
+               'throughput': { 'offered': sent / elapsed, 'broker': len (observer.broker_hop) / elapsed,
+                               'car': car_events / elapsed },
+               'latency': { 'broker': summarise (observer.broker_hop),
+                            'car': summarise (sum ([dash.car_hop for dash in dashes], [])),
+                            'return': summarise (sum ([dash.return_hop for dash in dashes], [])),
+                            'round_trip': summarise (sum ([dash.round_trip for dash in dashes], [])) },
+               'car': { 'folded': stats['folded'], 'queue': stats['queue'], 'outbound': stats['outbound'] },
+               'broker': broker.counters () }
+    return result
+
+def parse_list (text, kind):
+    return [kind (value) for value in text.split (',') if value]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser (description='Benchmark the round trip from dashboards through MQTT to car.py and back.')
+    parser.add_argument ('--quick', action='store_true', help='fewer configurations, shorter runs')
+    parser.add_argument ('--output', default=None, help='write the JSON results to this file')
+    parser.add_argument ('--dashboards', default=None, help='numbers of dashboards, comma separated')
+    parser.add_argument ('--rates', default=None, help='messages per second from each dashboard, comma separated')
+    parser.add_argument ('--duration', type=float, default=None, help='seconds per configuration')
+    args = parser.parse_args ()
+
+    if args.quick:
+        dashboards, rates, duration = [1, 8], [20, 100], 1.0
+    else:
+        dashboards, rates, duration = [1, 4, 16, 64], [10, 50, 200, 1000], 5.0
+    if args.dashboards:
+        dashboards = parse_list (args.dashboards, int)
+    if args.rates:
+        rates = parse_list (args.rates, float)
+    if args.duration:
+        duration = args.duration
+
+    results = { 'python': platform.python_version (), 'machine': platform.machine (), 'time': time.time (),
+                'quick': args.quick, 'paho': paho.mqtt.__version__, 'runs': [] }
+    for n in dashboards:
+        for rate in rates:
+            results['runs'].append (bench_run (n, rate, duration))
+    ceiling = { 'offered': 0.0, 'broker': 0.0, 'car': 0.0 }
+    for run in results['runs']:
+        for hop in ceiling:
+            ceiling[hop] = max (ceiling[hop], run['throughput'][hop])
+    results['ceiling'] = ceiling # the highest rate seen at each hop, in messages per second
+
+    text = json.dumps (results, indent=2, sort_keys=True)
+    if args.output is None:
+        print (text)
+    else:
+        with open (args.output, 'w') as f:
+            f.write (text + '\n')
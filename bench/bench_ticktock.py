@@ -0,0 +1,191 @@
+# Benchmarks for the ticktock event queue controllers in wifi-py-rpi/ and web-py-server/
+#
+# Measures event throughput through qController.event(), tick period error at a range of timer intervals, how long
+# stop() takes to bring run() to an end, CPU use while the controller is idle, and how fast ticks go on virtual time. Results are printed (or written)
+# as JSON, so that they can be compared from one run to the next.
+#
+#   python bench_ticktock.py [--quick] [--output results.json] [--module wifi-py-rpi|web-py-server]
+
+import os
+import json
+import time
+import argparse
+import platform
+import threading
+
+bench_dir = os.path.dirname (os.path.abspath (__file__))
+repo_dir = os.path.dirname (bench_dir)
+
+modules = {
+    'wifi-py-rpi':   os.path.join (repo_dir, 'wifi-py-rpi',   'ticktock.py'),
+    'web-py-server': os.path.join (repo_dir, 'web-py-server', 'ticktock.py')
+}
+
+def load_ticktock (name):
+    # both copies are called ticktock, so load each under a name of its own
+    path = modules[name]
+    module_name = 'ticktock_' + name.replace ('-', '_')
+    try:
+        import importlib.util
+        spec = importlib.util.spec_from_file_location (module_name, path)
+        module = importlib.util.module_from_spec (spec)
+        spec.loader.exec_module (module)
+    except ImportError: # Python 2
+        import imp
+        module = imp.load_source (module_name, path)
+    return module
+
+def cpu_time ():
+    t = os.times ()
+    return t[0] + t[1]
+
+def summarise (values):
+    if not values:
+        return { 'count': 0, 'mean': 0.0, 'p99': 0.0, 'max': 0.0 }
+    ordered = sorted (values)
+    p99 = ordered[min (len (ordered) - 1, int (0.99 * len (ordered)))]
+    return { 'count': len (values), 'mean': sum (values) / len (values), 'p99': p99, 'max': ordered[-1] }
+
+class bench_handler (object):
+    def __init__ (self, clock, events=0, tocks=0):
+        self.clock = clock
+        self.events_wanted = events
+        self.tocks_wanted = tocks
+        self.events = 0
+        self.tock_times = []
+        self.t_last_event = None
+        return
+
+    def tock (self, data):
+        self.tock_times.append (self.clock ())
+        if self.tocks_wanted > 0 and len (self.tock_times) >= self.tocks_wanted:
+            return False
+        return True
+
+    def event (self, name, value):
+        self.events += 1
+        if self.events == self.events_wanted:
+            self.t_last_event = self.clock ()
+            return False
+        return True
+
+def start (controller):
+    t = threading.Thread (target=controller.run)
+    t.start ()
+    time.sleep (0.05) # let run() get going before anything is added to the queue
+    return t
+
+def bench_throughput (ticktock, count, producers=1):
+    h = bench_handler (ticktock.qClock, events=count * producers)
+    c = ticktock.qController (h, 1.0)
+    t = start (c)
+
+    def produce ():
+        for i in range (0, count):
+            c.event ('bench', i)
+        return
+
+    threads = [threading.Thread (target=produce) for p in range (0, producers)]
+    t_start = ticktock.qClock ()
+    for p in threads:
+        p.start ()
+    for p in threads:
+        p.join ()
+    t_queued = ticktock.qClock ()
+    t.join ()
+
+    elapsed = h.t_last_event - t_start
+    return { 'producers': producers, 'events': count * producers,
+             'events_per_second': count * producers / elapsed,
+             'enqueue_per_second': count * producers / (t_queued - t_start) }
+
+def bench_tick_error (ticktock, interval, duration):
+    tocks = max (5, int (duration / interval))
+    h = bench_handler (ticktock.qClock, tocks=tocks)
+    c = ticktock.qController (h, interval)
+    c.run ()
+
+    errors = []
+    for i in range (1, len (h.tock_times)):
+        errors.append (abs (h.tock_times[i] - h.tock_times[i-1] - interval))
+    result = summarise (errors)
+    result['interval'] = interval
+    result['missed'] = c.ticker.missed
+    result['late'] = c.ticker.late
+    return result
+
+def bench_stop_latency (ticktock, repeats):
+    latencies = []
+    for r in range (0, repeats):
+        h = bench_handler (ticktock.qClock)
+        c = ticktock.qController (h, 0.1)
+        t = start (c)
+        t_stop = ticktock.qClock ()
+        c.stop ()
+        t.join ()
+        latencies.append (ticktock.qClock () - t_stop)
+    return summarise (latencies)
+
+def bench_idle_cpu (ticktock, interval, duration):
+    h = bench_handler (ticktock.qClock)
+    c = ticktock.qController (h, interval)
+    t = start (c)
+    cpu_start = cpu_time ()
+    wall_start = time.time ()
+    time.sleep (duration)
+    cpu = cpu_time () - cpu_start
+    wall = time.time () - wall_start
+    c.stop ()
+    t.join ()
+    return { 'interval': interval, 'seconds': wall, 'cpu_seconds': cpu, 'cpu_fraction': cpu / wall }
+
+def bench_virtual (ticktock, interval, tocks):
+    # the controller's own overhead per tick, with no waiting: on virtual time, ticks are dispatched back to back
+    clock = ticktock.qVirtualClock ()
+    h = bench_handler (clock, tocks=tocks)
+    c = ticktock.qController (h, interval, clock=clock)
+    t_start = ticktock.qClock ()
+    c.run ()
+    elapsed = ticktock.qClock () - t_start
+    return { 'interval': interval, 'tocks': len (h.tock_times), 'virtual_seconds': clock (),
+             'tocks_per_second': len (h.tock_times) / elapsed, 'speedup': clock () / elapsed }
+
+def bench_module (name, bQuick):
+    ticktock = load_ticktock (name)
+    if bQuick:
+        count, duration, repeats, idle = 5000, 0.5, 5, 1.0
+        intervals = [0.001, 0.01, 0.1]
+    else:
+        count, duration, repeats, idle = 50000, 2.0, 20, 5.0
+        intervals = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0]
+
+    result = {}
+    result['throughput'] = [bench_throughput (ticktock, count, 1), bench_throughput (ticktock, count // 4, 4)]
+    result['tick_error'] = [bench_tick_error (ticktock, interval, max (duration, 5 * interval)) for interval in intervals]
+    result['stop_latency'] = bench_stop_latency (ticktock, repeats)
+    result['idle_cpu'] = bench_idle_cpu (ticktock, 0.1, idle)
+    result['virtual'] = bench_virtual (ticktock, 0.1, 10 * count)
+    return result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser (description='Benchmark the ticktock event queue controllers.')
+    parser.add_argument ('--quick', action='store_true', help='fewer events, shorter runs')
+    parser.add_argument ('--output', default=None, help='write the JSON results to this file')
+    parser.add_argument ('--module', choices=sorted (modules), action='append', help='module(s) to benchmark (default: all)')
+    args = parser.parse_args ()
+
+    names = args.module
+    if not names:
+        names = sorted (modules)
+
+    results = { 'python': platform.python_version (), 'machine': platform.machine (), 'time': time.time (),
+                'quick': args.quick, 'modules': {} }
+    for name in names:
+        results['modules'][name] = bench_module (name, args.quick)
+
+    text = json.dumps (results, indent=2, sort_keys=True)
+    if args.output is None:
+        print (text)
+    else:
+        with open (args.output, 'w') as f:
+            f.write (text + '\n')
@@ -1,5 +1,11 @@
 var client;
 
+/* topics for the car/... and dash/... messages; in a fleet (see wifi-py-rpi/fleet.py) each car has its own, chosen
+ * with ?car=<name> on the dashboard's URL
+ */
+var topic_root = "/wifi-py-rpi-car-controller";
+var car_root = topic_root;
+
 var power_options_displayed = true;
 var power_options = null;
 
@@ -18,28 +24,64 @@ function power () {
 }
 
 function power_car () {
-    message = new Paho.MQTT.Message ("car");
-    message.destinationName = "/wifi-py-rpi-car-controller/system/exit";
+    message = new Paho.MQTT.Message (car_root == topic_root ? "car" : "car-" + car_name ());
+    message.destinationName = topic_root + "/system/exit";
     client.send (message);
 }
 
 function power_controller () {
     message = new Paho.MQTT.Message ("controller");
-    message.destinationName = "/wifi-py-rpi-car-controller/system/exit";
+    message.destinationName = topic_root + "/system/exit";
     client.send (message);
 }
 
+/* XY payloads (see wifi-py-rpi/xycodec.py) are text, "x y", unless the car has announced that it can decode the
+ * compact binary form, version 1: '<BBIdff' - version, flags, sequence number, timestamp (s), x, y
+ */
+var xy_binary = false;
+var xy_sequence = 0;
+
+function xy_encode_binary (x, y) {
+    var buffer = new ArrayBuffer (22);
+    var view = new DataView (buffer);
+
+    xy_sequence = (xy_sequence + 1) % 4294967296;
+
+    view.setUint8   (0, 1); // version
+    view.setUint8   (1, 0); // flags
+    view.setUint32  (2, xy_sequence, true);
+    view.setFloat64 (6, Date.now () / 1000, true);
+    view.setFloat32 (14, x, true);
+    view.setFloat32 (18, y, true);
+    return buffer;
+}
+
+function xy_decode (message) { // returns [x, y]
+    var bytes = message.payloadBytes;
+
+    if ((bytes.length == 22) && (bytes[0] == 1)) {
+	var view = new DataView (bytes.buffer, bytes.byteOffset, bytes.byteLength);
+	return [view.getFloat32 (14, true), view.getFloat32 (18, true)];
+    }
+    var xy_str = message.payloadString.split (" ");
+    return [parseFloat (xy_str[0]), parseFloat (xy_str[1])];
+}
+
+function xy_negotiate (announcement) { // the car's list of the encodings it can decode
+    xy_binary = (announcement.split (" ").indexOf ("xy1") >= 0);
+}
+
 function mqtt_send_XY (x, y) {
-    message = new Paho.MQTT.Message (x.toFixed (3) + " " + y.toFixed (3));
-    message.destinationName = "/wifi-py-rpi-car-controller/dash/XY";
+    if (xy_binary) {
+	message = new Paho.MQTT.Message (xy_encode_binary (x, y));
+    } else {
+	message = new Paho.MQTT.Message (x.toFixed (3) + " " + y.toFixed (3));
+    }
+    message.destinationName = car_root + "/dash/XY";
     client.send (message);
 }
 
-function mqtt_receive_XY (str) {
-    xy_str = str.split (" ");
-    x = parseFloat (xy_str[0]);
-    y = parseFloat (xy_str[1]);
-
+function mqtt_receive_XY (x, y) {
     var g3_rotate = -60 * y;
     svg_dial_needle ("g3", g3_rotate);
 
@@ -302,7 +344,13 @@ function onConnect () {
     // Once a connection has been made, make a subscription and send a message.
     mqtt_log_update ("onConnect");
 
-    client.subscribe ("/wifi-py-rpi-car-controller/car/XY");
+    client.subscribe (car_root + "/car/XY");
+    client.subscribe (car_root + "/car/encoding");
+
+    // tell the car which position encodings we can decode
+    message = new Paho.MQTT.Message ("xy1 text");
+    message.destinationName = car_root + "/dash/encoding";
+    client.send (message);
 }
 
 // called when the client loses its connection
@@ -314,14 +362,32 @@ function onConnectionLost (responseObject) {
 
 // called when a message arrives
 function onMessageArrived (message) {
-    mqtt_log_update ("onMessageArrived:" + message.payloadString);
+    if (message.destinationName == car_root + "/car/XY") {
+	var xy = xy_decode (message);
+	mqtt_log_update ("onMessageArrived:" + xy[0].toFixed (3) + " " + xy[1].toFixed (3));
+	mqtt_receive_XY (xy[0], xy[1]);
+    } else {
+	mqtt_log_update ("onMessageArrived:" + message.payloadString);
 
-    if (message.destinationName == "/wifi-py-rpi-car-controller/car/XY") {
-	mqtt_receive_XY (message.payloadString);
+	if (message.destinationName == car_root + "/car/encoding") {
+	    xy_negotiate (message.payloadString);
+	}
     }
 }
 
+function car_name () {
+    var match = /[?&]car=([^&]+)/.exec (window.location.search);
+    if (match) {
+	return decodeURIComponent (match[1]);
+    }
+    return null;
+}
+
 function get_started () {
+    if (car_name () != null) {
+	car_root = topic_root + "/fleet/" + car_name ();
+    }
+
     var mosquitto_host = window.location.hostname;
     var mosquitto_port = window.location.port;
 
@@ -0,0 +1,368 @@
+# Tests for the ticktock event queue controllers in wifi-py-rpi/ and web-py-server/
+#
+# Most run qController on virtual time (qVirtualClock), so that they are fast and deterministic: the clock only moves
+# when the controller has nothing left to do, or when a handler moves it on to stand for time spent working. The
+# handlers queue their own events from tock (), as the controller only takes events while it is running.
+#
+#   python -m pytest -q tests
+
+import os
+import time
+import tempfile
+import threading
+import unittest
+import importlib.util
+
+tests_dir = os.path.dirname (os.path.abspath (__file__))
+repo_dir = os.path.dirname (tests_dir)
+
+def load (directory):
+    # each copy of ticktock.py under a name of its own, so that both can be tested in one run
+    path = os.path.join (repo_dir, directory, 'ticktock.py')
+    spec = importlib.util.spec_from_file_location ('ticktock_' + directory.replace ('-', '_'), path)
+    module = importlib.util.module_from_spec (spec)
+    spec.loader.exec_module (module)
+    return module
+
+class script_handler (object):
+    # Calls script[n] (handler) at the n-th tock, records everything dispatched, and stops the controller after the
+    # last tock in the script (or after max_tocks, in case a test goes wrong)
+
+    def __init__ (self, clock, script=None, tocks=None, max_tocks=1000):
+        self.clock = clock
+        self.script = script or {}
+        if tocks is None:
+            tocks = max ([0] + list (self.script)) + 1
+        self.last_tock = min (tocks, max_tocks)
+        self.controller = None
+        self.tock_data = [] # (time, data) for each tock
+        self.events = []    # (time, name, value) for each event
+        return
+
+    def tock (self, data):
+        self.tock_data.append ((self.clock (), data))
+        n = len (self.tock_data)
+        action = self.script.get (n)
+        if action is not None:
+            action (self)
+        return n < self.last_tock
+
+    def event (self, name, value):
+        self.events.append ((self.clock (), name, value))
+        return True
+
+    def names (self):
+        return [name for t, name, value in self.events]
+
+    def values (self, name):
+        return [value for t, n, value in self.events if n == name]
+
+class ticktock_tests (object):
+    # Mixed into one unittest.TestCase per copy of ticktock.py; tt is the module
+
+    tt = None
+
+    def controller (self, script=None, interval=0.25, overrun=None, tocks=None):
+        clock = self.tt.qVirtualClock ()
+        handler = script_handler (clock, script, tocks)
+        if overrun is None:
+            overrun = self.tt.qOverrunSkip
+        c = self.tt.qController (handler, interval, overrun, clock=clock)
+        handler.controller = c
+        return c, handler, clock
+
+    # ---- virtual time and overrun policies
+
+    def test_virtual_ticks_are_on_time (self):
+        c, h, clock = self.controller (tocks=4)
+        t_start = time.time ()
+        c.run ()
+        self.assertLess (time.time () - t_start, 1.0) # 4 ticks of 0.25 s, but on virtual time
+        self.assertEqual ([t for t, data in h.tock_data], [0.25, 0.5, 0.75, 1.0])
+        ticks = c.snapshot ()['ticks']
+        self.assertEqual ((ticks['ticks'], ticks['missed'], ticks['late']), (4, 0, 0))
+
+    def slow_first_tock (self, h):
+        h.clock.advance (h.clock () + 0.875) # as if tock () had taken 0.875 s: deadlines 0.5, 0.75 and 1.0 pass
+
+    def test_overrun_skip (self):
+        c, h, clock = self.controller ({ 1: self.slow_first_tock }, tocks=3)
+        c.run ()
+        self.assertEqual ([t for t, data in h.tock_data], [0.25, 1.125, 1.25])
+        ticks = c.snapshot ()['ticks']
+        self.assertEqual ((ticks['ticks'], ticks['missed'], ticks['late']), (3, 2, 1))
+
+    def test_overrun_catchup (self):
+        c, h, clock = self.controller ({ 1: self.slow_first_tock }, overrun=self.tt.qOverrunCatchUp, tocks=5)
+        c.run ()
+        self.assertEqual ([t for t, data in h.tock_data], [0.25, 1.125, 1.125, 1.125, 1.25])
+        ticks = c.snapshot ()['ticks']
+        self.assertEqual ((ticks['ticks'], ticks['missed'], ticks['late']), (5, 0, 3)) # one late tick per deadline
+
+    def test_overrun_coalesce (self):
+        c, h, clock = self.controller ({ 1: self.slow_first_tock }, overrun=self.tt.qOverrunCoalesce, tocks=3)
+        c.run ()
+        self.assertEqual (h.tock_data, [(0.25, 1), (1.125, 3), (1.25, 1)]) # tock () receives the number of periods
+        ticks = c.snapshot ()['ticks']
+        self.assertEqual ((ticks['ticks'], ticks['missed'], ticks['late']), (3, 2, 1))
+
+    def test_timer (self):
+        fired = []
+        def callback (data):
+            fired.append (clock ())
+            return True
+        c, h, clock = self.controller (tocks=4)
+        c.add_timer ('half', 0.5, callback)
+        c.run ()
+        self.assertEqual (fired, [0.5, 1.0])
+        self.assertEqual (c.snapshot ()['timers']['half']['ticks'], 2)
+
+    # ---- coalescing, deadlines and overflow
+
+    def test_coalesce (self):
+        def queue (h):
+            for i in range (0, 5):
+                h.controller.event ('xy', i)
+            h.controller.event ('other', 'a')
+            h.controller.event ('xy', 5)
+        c, h, clock = self.controller ({ 1: queue }, tocks=2)
+        c.coalesce ('xy')
+        c.run ()
+        self.assertEqual (h.names (), ['xy', 'other']) # the latest value, in the place of the first
+        self.assertEqual (h.values ('xy'), [5])
+        self.assertEqual (c.snapshot ()['folded'], 5)
+
+    def test_deadline_expiry (self):
+        def queue (h):
+            h.controller.event ('short', 1, ttl=0.125)
+            h.controller.event ('long', 2, ttl=0.5)
+            h.controller.event ('absolute', 3, deadline=0.375)
+            h.controller.event ('none', 4)
+            h.clock.advance (h.clock () + 0.25) # tock () takes long enough for 'short' and 'absolute' to expire
+        c, h, clock = self.controller ({ 1: queue }, tocks=2)
+        c.run ()
+        self.assertEqual (h.names (), ['long', 'none'])
+        self.assertEqual (c.snapshot ()['queue']['expired'], 2)
+
+    def test_earliest_deadline_first (self):
+        def queue (h):
+            h.controller.event ('later', 1, ttl=0.5)
+            h.controller.event ('sooner', 2, ttl=0.125)
+        c, h, clock = self.controller ({ 1: queue }, tocks=2)
+        c.run ()
+        self.assertEqual (h.names (), ['sooner', 'later'])
+
+    def overflow (self, policy):
+        # queues four events into room for two, from tock () - i.e., from the dispatch thread
+        results = []
+        def queue (h):
+            for name in ('a', 'b', 'c', 'd'):
+                results.append (h.controller.event (name))
+        c, h, clock = self.controller ({ 1: queue }, tocks=2)
+        c.limit (2, policy)
+        c.run ()
+        return results, h.names (), c.snapshot ()['queue']
+
+    def test_overflow_drop_oldest (self):
+        results, names, queue = self.overflow (self.tt.qOverflowDropOldest)
+        self.assertEqual ((results, names, queue['dropped_oldest']), ([True] * 4, ['c', 'd'], 2))
+
+    def test_overflow_drop_newest (self):
+        results, names, queue = self.overflow (self.tt.qOverflowDropNewest)
+        self.assertEqual ((results, names, queue['dropped_newest']), ([True, True, False, False], ['a', 'b'], 2))
+
+    def test_overflow_reject (self):
+        results, names, queue = self.overflow (self.tt.qOverflowReject)
+        self.assertEqual ((results, names, queue['rejected']), ([True, True, False, False], ['a', 'b'], 2))
+
+    def test_overflow_block_never_blocks_the_dispatch_thread (self):
+        results, names, queue = self.overflow (self.tt.qOverflowBlock)
+        self.assertEqual ((results, names, queue['rejected']), ([True, True, False, False], ['a', 'b'], 2))
+
+    def test_overflow_block_timeout (self):
+        q = self.tt.qQueue ()
+        q.limit (1, self.tt.qOverflowBlock, 0.05)
+        self.assertTrue (q.put (self.tt.qPriorityNormal, self.tt.qData ('a')))
+        t_start = time.time ()
+        self.assertFalse (q.put (self.tt.qPriorityNormal, self.tt.qData ('b'))) # nobody takes 'a'
+        self.assertGreaterEqual (time.time () - t_start, 0.04)
+        self.assertEqual (q.counters ()['timeouts'], 1)
+
+    def test_overflow_block_waits_for_room (self):
+        q = self.tt.qQueue ()
+        q.limit (1, self.tt.qOverflowBlock)
+        q.put (self.tt.qPriorityNormal, self.tt.qData ('a'))
+        results = []
+        producer = threading.Thread (target=lambda: results.append (q.put (self.tt.qPriorityNormal, self.tt.qData ('b'))))
+        producer.start ()
+        time.sleep (0.05)
+        self.assertEqual (results, []) # still waiting for room
+        self.assertEqual (q.get ()[1].event_type, 'a')
+        producer.join (2)
+        self.assertEqual (results, [True])
+
+    def test_overflow_block_released_on_stop (self):
+        q = self.tt.qQueue ()
+        q.limit (1, self.tt.qOverflowBlock)
+        q.put (self.tt.qPriorityNormal, self.tt.qData ('a'))
+        results = []
+        producer = threading.Thread (target=lambda: results.append (q.put (self.tt.qPriorityNormal, self.tt.qData ('b'))))
+        producer.start ()
+        time.sleep (0.05)
+        q.close () # as the controller does as it stops
+        producer.join (2)
+        self.assertFalse (producer.is_alive ())
+        self.assertEqual ((results, q.counters ()['rejected']), ([False], 1))
+
+    # ---- priority classes: tick aging and maximum delay
+
+    def waiting_tick (self, max_delay='default'):
+        # a controller that isn't running, with a tick and two normal events waiting, all queued at time 0
+        c, h, clock = self.controller (interval=0.1)
+        if max_delay != 'default':
+            c.tick_max_delay (max_delay)
+        q = c.TickTock
+        q.put (self.tt.qPriorityLow, self.tt.qData ('tick', c.ticker, t_queued=0.0), False)
+        q.put (self.tt.qPriorityNormal, self.tt.qData ('a', t_queued=0.0))
+        q.put (self.tt.qPriorityNormal, self.tt.qData ('b', t_queued=0.0))
+        return q, clock
+
+    def test_tick_max_delay_default (self):
+        q, clock = self.waiting_tick ()
+        self.assertEqual (q.classes[self.tt.qPriorityLow].max_delay, 0.05) # half the tick interval
+        clock.advance (0.01)
+        self.assertEqual (q.take ()[1].event_type, 'a')
+        clock.advance (0.0625) # the tick has now waited longer than max_delay
+        self.assertEqual (q.take ()[1].event_type, 'tick')
+        self.assertEqual (q.counters ()['classes']['low']['promoted'], 1)
+
+    def test_tick_aging (self):
+        q, clock = self.waiting_tick (None)
+        clock.advance (0.05) # the tick ranks at 2 - 10 * 0.05 = 1.5, behind normal events (1)
+        self.assertEqual (q.take ()[1].event_type, 'a')
+        clock.advance (0.125) # 2 - 10 * 0.125 = 0.75, ahead of them
+        self.assertEqual (q.take ()[1].event_type, 'tick')
+        self.assertEqual (q.take ()[1].event_type, 'b')
+
+    def test_priority_any_number (self):
+        def queue (h):
+            h.controller.event ('low', priority=5)
+            h.controller.event ('fraction', priority=1.5)
+            h.controller.event ('urgent', priority=-1)
+        c, h, clock = self.controller ({ 1: queue }, tocks=2)
+        c.run ()
+        self.assertEqual (h.names (), ['urgent', 'fraction', 'low'])
+
+    # ---- journal and replay
+
+    def journal_path (self):
+        f = tempfile.NamedTemporaryFile (suffix='.ttj', delete=False)
+        f.close ()
+        self.addCleanup (os.remove, f.name)
+        return f.name
+
+    def test_journal_replay (self):
+        values = [None, b'\x00\x01', u'text é', 42, -7, 2.5, { 'x': [1, 2] }, (1.0, -1.0)]
+        def queue (h):
+            for i, value in enumerate (values):
+                h.controller.event ('e%d' % i, value)
+        c, h, clock = self.controller ({ 1: queue }, tocks=3)
+        path = self.journal_path ()
+        c.journal (path)
+        c.run ()
+
+        records = list (self.tt.qJournal_read (path))
+        self.assertEqual ([(kind, name) for t, p, kind, name, data in records if kind == self.tt.qJournalTick],
+                          [(self.tt.qJournalTick, 'tick')] * 3)
+        self.assertEqual ([data for t, p, kind, name, data in records if kind == self.tt.qJournalEvent], values)
+        self.assertEqual ([t for t, p, kind, name, data in records if kind == self.tt.qJournalTick], [0.25, 0.5, 0.75])
+
+        # replayed into a fresh handler, it sees the same calls at the same (virtual) times
+        r, replayed, r_clock = self.controller (tocks=1000)
+        summary = self.tt.qReplay (path).run (r)
+        self.assertEqual (summary['records'], len (records))
+        self.assertEqual (replayed.events, h.events)
+        self.assertEqual (replayed.tock_data, h.tock_data)
+
+    def test_journal_survives_odd_priorities_and_data (self):
+        # regression: a priority that didn't fit a byte, or unpicklable data, killed the journal's writer thread and
+        # left run () unable to start again
+        def queue (h):
+            h.controller.event ('negative', 1, priority=-1)
+            h.controller.event ('fraction', 2, priority=1.5)
+            h.controller.event ('unpicklable', lambda: 0)
+            h.controller.event ('plain', 3)
+        c, h, clock = self.controller ({ 1: queue }, tocks=2)
+        path = self.journal_path ()
+        c.journal (path)
+        recorder = c.recorder
+        c.run ()
+        self.assertEqual (recorder.dropped, 1)
+        events = [(p, name, data) for t, p, kind, name, data in self.tt.qJournal_read (path) if kind == self.tt.qJournalEvent]
+        self.assertEqual (events, [(-1, 'negative', 1), (1, 'plain', 3), (1.5, 'fraction', 2)])
+
+        h.tock_data = []
+        h.script = {}
+        h.last_tock = 1
+        c.run () # the controller can run again
+        self.assertEqual (len (h.tock_data), 1)
+
+    # ---- dispatch pool (on real time: the handlers run on worker threads)
+
+    def test_pool_never_deadlocks_under_block (self):
+        # regression: a worker whose handler queued an event waited for room, while the dispatch thread waited for
+        # the worker, so nothing was taken from the queue again
+        class requeue (object):
+            def __init__ (self):
+                self.count = 0
+                self.controller = None
+            def tock (self, data):
+                return True
+            def event (self, name, value):
+                self.count += 1
+                self.controller.event ('e', value)
+                self.controller.event ('e', value)
+                return True
+        h = requeue ()
+        c = self.tt.qController (h, 0.05)
+        h.controller = c
+        c.parallel (1)
+        c.limit (4, self.tt.qOverflowBlock)
+        t = threading.Thread (target=c.run)
+        t.start ()
+        try:
+            while not c.event ('e', 0):
+                time.sleep (0.01)
+            time.sleep (0.2)
+            before = h.count
+            time.sleep (0.3)
+            self.assertGreater (h.count, before)
+        finally:
+            c.stop ()
+            t.join (5)
+        self.assertFalse (t.is_alive ())
+
+    # ---- sample ring buffer
+
+    def test_ring_headroom (self):
+        if self.tt.numpy is None:
+            self.skipTest ('qRing requires numpy')
+        r = self.tt.qRing (4, 1)
+        for i in range (0, 4):
+            r.push (i, i)
+        first = r.drain ()
+        for i in range (4, 8): # room for capacity more, although the first drain's samples are still in use
+            self.assertTrue (r.push (i, i))
+        self.assertFalse (r.push (8, 8))
+        self.assertEqual (first[:,0].tolist (), [0, 1, 2, 3])
+        self.assertEqual (r.drain ()[:,0].tolist (), [4, 5, 6, 7])
+        self.assertEqual (r.counters ()['overruns'], 1)
+
+class test_wifi_ticktock (ticktock_tests, unittest.TestCase):
+    tt = load ('wifi-py-rpi')
+
+class test_web_ticktock (ticktock_tests, unittest.TestCase):
+    tt = load ('web-py-server')
+
+if __name__ == "__main__":
+    unittest.main ()
@@ -0,0 +1,155 @@
+# asyncio version of ticktock.qController (Python 3 only)
+#
+# The event handler contract is the same: handler.tock (data) is called periodically, handler.event (name, value)
+# for each event, and either returning False stops the controller. Everything - the controller, the tick scheduler
+# and the dispatch of events added by web.py's request threads - runs on one asyncio event loop, so each request
+# reaches handler.event() with a single thread hand-off.
+
+import asyncio
+import threading
+
+import ticktock
+
+from ticktock import qOverrunSkip
+
+class qAsyncScheduler (object):
+    # Serves the controller's timers from the event loop (whose own timer heap does the ordering)
+
+    def __init__ (self):
+        self.timers = []
+        self.handles = {}
+        self.loop = None
+        self.loop_thread = None
+        self.settings = None # there's no thread of its own to apply qThreadSettings to
+        return
+
+    def add (self, timer):
+        if timer not in self.timers:
+            self.timers.append (timer)
+        if self.loop is not None:
+            self.schedule (timer, self.loop.time ())
+        return
+
+    def remove (self, timer):
+        timer.bActive = False
+        if timer in self.timers:
+            self.timers.remove (timer)
+        handle = self.handles.pop (timer, None)
+        if handle is not None:
+            handle.cancel ()
+        return
+
+    def reschedule (self, timer, deadline):
+        if self.loop is None:
+            return
+        if threading.get_ident () != self.loop_thread: # e.g., an event from paho's network thread
+            self.loop.call_soon_threadsafe (self.reschedule, timer, deadline)
+            return
+        handle = self.handles.get (timer)
+        if handle is not None:
+            handle.cancel ()
+        timer.deadline = deadline
+        self.handles[timer] = self.loop.call_at (deadline, self.fire, timer)
+        return
+
+    def schedule (self, timer, now):
+        timer.reset (now)
+        self.handles[timer] = self.loop.call_at (timer.deadline, self.fire, timer)
+        return
+
+    def fire (self, timer):
+        count = timer.advance (self.loop.time ())
+        self.handles[timer] = self.loop.call_at (timer.deadline, self.fire, timer)
+        timer.deliver (count)
+        return
+
+    def start (self):
+        self.loop = asyncio.get_event_loop ()
+        self.loop_thread = threading.get_ident ()
+        now = self.loop.time ()
+        for timer in self.timers:
+            self.schedule (timer, now)
+        return
+
+    def stop (self):
+        for timer in self.handles:
+            self.handles[timer].cancel ()
+        self.handles = {}
+        self.loop = None
+        return
+
+class AsyncQController (ticktock.qController):
+    def __init__ (self, default_event_handler, timer_interval, overrun=qOverrunSkip):
+        ticktock.qController.__init__ (self, default_event_handler, timer_interval, overrun)
+        self.wakeup = None # created by run(), on the event loop
+        self.scheduler = qAsyncScheduler ()
+        self.scheduler.add (self.ticker)
+        self.loop = None
+        self.loop_thread = None
+        self.bListening = False
+        return
+
+    def parallel (self, workers, key=None):
+        # handlers are always dispatched on the event loop; use ticktock.qController for a pool of worker threads
+        if workers > 0:
+            raise ValueError ('AsyncQController does not support parallel dispatch')
+        return
+
+    def put (self, priority, q, bEvent=True):
+        if not self.bListening:
+            return False
+        bLoop = (threading.get_ident () == self.loop_thread)
+        bQueued = self.TickTock.put (priority, q, bEvent, not bLoop) # the event loop itself must never wait
+        self.stats.queued (len (self.TickTock))
+        if bQueued and not self.wakeup.is_set ():
+            if bLoop:
+                self.wakeup.set ()
+            else: # from another thread, e.g., one of web.py's request threads
+                self.loop.call_soon_threadsafe (self.wakeup.set)
+        return bQueued
+
+    async def run (self):
+        if self.bListening:
+            return False
+
+        self.loop = asyncio.get_event_loop ()
+        self.loop_thread = threading.get_ident ()
+        self.wakeup = asyncio.Event ()
+        self.TickTock.clear ()
+        self.coalescer.clear ()
+        self.TickTock.open ()
+
+        self.bListening = True
+
+        self.thread_setup ('dispatch') # the event loop's thread; the timers are served by the loop itself
+        self.scheduler.start ()
+
+        try:
+            while True:
+                item = self.TickTock.get_nowait ()
+                if item is None:
+                    self.wakeup.clear ()
+                    item = self.TickTock.get_nowait () # in case something arrived just before the clear ()
+                    if item is None:
+                        await self.wakeup.wait ()
+                        continue
+                p, q = item
+
+                if q.event_type == 'stop':
+                    break
+
+                if not self.dispatch (p, q):
+                    break
+        finally:
+            self.bListening = False
+            self.TickTock.close () # producers waiting for room in another thread give up
+            self.thread_exit ()
+            self.scheduler.stop ()
+            self.journal (None)
+        return True
+
+def run_in_thread (queue_controller):
+    # run the controller on its own event loop in a background thread; events may be added from any thread
+    t = threading.Thread (target=asyncio.run, args=(queue_controller.run (),))
+    t.start ()
+    return t
@@ -4,17 +4,47 @@ import threading
 import server
 import ticktock
 
+# run the controller on an asyncio event loop; requests from web.py are handed straight to it (Python 3.7+)
+use_asyncio = False
+
+if use_asyncio:
+    import asyncticktock
+
+# commands that can't be handled within this many seconds are dropped as stale
+command_ttl = 1.0
+
+# tock() is called at most this many seconds after it is due, however many commands are waiting; keep it well under
+# the tick interval (see below), so that busy spells don't cost whole ticks
+tick_max_delay = 0.05
+
+# run the controller's threads on these CPUs (e.g., [3]) and/or with a real-time scheduling policy (ticktock.qSchedFIFO
+# or ticktock.qSchedRR, which usually need root); None to leave them to the OS - what actually applied is printed
+controller_cpus = None
+controller_policy = None
+
 def run_queue (queue_controller): # DO NOT TOUCH
     queue_controller.run ()
     return
 
 # It is possible to create a separate thread dedicated to checking the sensors, which might send events when necessary.
+# Or, to keep sensor polling away from the GIL altogether, run it in a process of its own with sensorticktock.qSampler,
+# and read the latest frame in tock().
 # I have no idea how to stream the camera. That will probably need to be handled in server.py, though.
 
 class car_controller (object):
     def __init__ (self):
-        self.queue_controller = ticktock.qController (self, 0.5) # 0.5 = half a second, which is quite slow; try 0.05, maybe
+        if use_asyncio:
+            self.queue_controller = asyncticktock.AsyncQController (self, 0.5)
+        else:
+            self.queue_controller = ticktock.qController (self, 0.5) # 0.5 = half a second, which is quite slow; try 0.05, maybe
+        self.queue_controller.limit (32, ticktock.qOverflowReject) # refused commands get 503 Service Unavailable
+        self.queue_controller.tick_max_delay (tick_max_delay)
+        if controller_cpus is not None or controller_policy is not None:
+            self.queue_controller.pin ('dispatch', controller_cpus, controller_policy)
+            self.queue_controller.pin ('scheduler', controller_cpus, controller_policy)
 # Initialise variables here:
+# e.g., self.queue_controller.on ('stop', self.emergency_stop) to handle one command with a method of its own, or
+# self.queue_controller.batch ('steer') to have event_batch() handle every waiting 'steer' command in one go
 
 # ----
         return
@@ -33,6 +63,13 @@ class car_controller (object):
 # ----
         return True
 
+    def event_batch (self, name, values):
+# Called instead of event() for commands enabled with self.queue_controller.batch (name): values is a list
+        for value in values:
+            self.event (name, value)
+# ----
+        return True
+
     def query (self, name, value):
         response = ''
 # This is a request from the human interface
@@ -59,14 +96,22 @@ class car_controller (object):
 # ======== DO NOT TOUCH ANYTHING BELOW THIS LINE ========
 
     def command (self, name, value):
-        self.queue_controller.event (name, value)
-        return
+        return self.queue_controller.event (name, value, None, command_ttl) # False if the queue is full and the command was refused
+
+    def stats (self, reset=False):
+        return self.queue_controller.snapshot (reset)
+
+    def profile (self, action):
+        return self.queue_controller.profile (action)
 
     def stop (self):
         self.queue_controller.stop ()
         return
 
     def run_in_background (self):
+        if use_asyncio:
+            asyncticktock.run_in_thread (self.queue_controller)
+            return
         t = threading.Thread (target=run_queue, args=(self.queue_controller,))
         t.start ()
         return
@@ -0,0 +1,202 @@
+# Several ticktock controllers in processes of their own, passing events to each other (Python 3)
+#
+# Each node of a qCluster is a process with its own ticktock.qController and event handler, so that, e.g., the control
+# loop, the network I/O and heavy sensor or vision work can each have a core (and a GIL) to itself. The handlers are
+# written just as for a single controller - tock (data) and event (name, value) - and pass events on with
+# link.send (name, value), which routes them by name to whichever node handles them. Every pair of nodes has a pipe of
+# its own in each direction, so that there is never more than one writer per pipe.
+#
+#   def make_control (link):      # called in the node's own process; returns its event handler
+#       return control_handler (link)
+#
+#   cluster = qCluster ()
+#   cluster.node ('control', make_control, 0.1, ['/dash/XY', 'range'])
+#   cluster.node ('sensors', make_sensors, 0.01)
+#   cluster.start ()
+#   cluster.supervise () # until a node stops
+#
+# The factories must be picklable (defined at module level) unless the platform forks.
+
+import time
+import threading
+import multiprocessing
+
+from multiprocessing.connection import wait
+
+import ticktock
+
+from ticktock import qPriorityNormal
+
+qClusterSupervisor = '' # the name of the supervisor (the process that started the cluster) as a source of events
+
+class qClusterLink (object):
+    # A node's view of the cluster: send () events to the node that handles them
+
+    def __init__ (self, name, routes, outbound):
+        self.name = name
+        self.routes = routes     # event name -> node name
+        self.outbound = outbound # node name -> Connection to it
+        self.locks = {}          # node name -> lock, as handlers may send from several threads
+        for node in outbound:
+            self.locks[node] = threading.Lock ()
+        self.controller = None   # this node's qController
+        self.sent = 0
+        self.received = 0
+        self.unrouted = 0
+        return
+
+    def send (self, event_type, data=None, priority=qPriorityNormal):
+        # returns False if no node handles event_type, or the event was refused
+        node = self.routes.get (event_type)
+        if node is None:
+            self.unrouted += 1
+            return False
+        if node == self.name:
+            return self.controller.event (event_type, data, priority=priority)
+        with self.locks[node]:
+            try:
+                self.outbound[node].send (('event', event_type, data, priority))
+            except (OSError, EOFError): # the node has gone
+                return False
+        self.sent += 1
+        return True
+
+    def listen (self, inbound):
+        # passes events arriving from the other nodes to this node's controller, until they have all gone
+        while not getattr (self.controller, 'bListening', True): # a controller refuses events until it runs
+            time.sleep (0.01)
+        inbound = list (inbound)
+        while inbound:
+            for conn in wait (inbound):
+                try:
+                    message = conn.recv ()
+                except (EOFError, OSError):
+                    inbound.remove (conn)
+                    continue
+                if message[0] == 'stop':
+                    self.controller.stop ()
+                else:
+                    self.received += 1
+                    self.controller.event (message[1], message[2], priority=message[3])
+        return
+
+    def close (self):
+        for node in self.outbound:
+            self.outbound[node].close ()
+        return
+
+    def counters (self):
+        return { 'sent': self.sent, 'received': self.received, 'unrouted': self.unrouted }
+
+def qCluster_main (name, factory, timer_interval, routes, inbound, outbound):
+    # a node's process
+    link = qClusterLink (name, routes, outbound)
+    handler = factory (link)
+    link.controller = ticktock.qController (handler, timer_interval)
+    listener = threading.Thread (target=link.listen, args=(inbound,), name='cluster-listener')
+    listener.daemon = True
+    listener.start ()
+    try:
+        link.controller.run ()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        link.close ()
+    return
+
+class qCluster (object):
+    def __init__ (self):
+        self.nodes = {}  # name -> (factory, timer_interval)
+        self.order = []
+        self.routes = {} # event name -> node name
+        self.processes = {}
+        self.outbound = {} # node name -> Connection from the supervisor
+        self.lock = threading.Lock ()
+        return
+
+    def node (self, name, factory, timer_interval, event_types=()):
+        # adds a node, whose handler is factory (link), handling events with the names in event_types
+        if name == qClusterSupervisor or name in self.nodes:
+            raise ValueError ('bad or duplicate node name: ' + repr (name))
+        self.nodes[name] = (factory, timer_interval)
+        self.order.append (name)
+        for event_type in event_types:
+            self.route (event_type, name)
+        return
+
+    def route (self, event_type, name):
+        # events called event_type go to the node called name; call before start ()
+        self.routes[event_type] = name
+        return
+
+    def start (self):
+        sources = [qClusterSupervisor] + self.order
+        pipes = {} # (from, to) -> (receiving end, sending end)
+        for source in sources:
+            for node in self.order:
+                if source != node:
+                    pipes[(source, node)] = multiprocessing.Pipe (False)
+
+        for name in self.order:
+            factory, timer_interval = self.nodes[name]
+            inbound = [pipes[(source, name)][0] for source in sources if source != name]
+            outbound = {}
+            for node in self.order:
+                if node != name:
+                    outbound[node] = pipes[(name, node)][1]
+            process = multiprocessing.Process (target=qCluster_main, name='cluster-' + name,
+                                               args=(name, factory, timer_interval, self.routes, inbound, outbound))
+            process.start ()
+            self.processes[name] = process
+
+        # keep only the supervisor's own sending ends
+        for key in pipes:
+            receiving, sending = pipes[key]
+            receiving.close ()
+            if key[0] == qClusterSupervisor:
+                self.outbound[key[1]] = sending
+            else:
+                sending.close ()
+        return
+
+    def send (self, event_type, data=None, priority=qPriorityNormal):
+        # from the supervisor to the node that handles event_type; returns False if there is none, or it has gone
+        node = self.routes.get (event_type)
+        if node is None or node not in self.outbound:
+            return False
+        try:
+            with self.lock:
+                self.outbound[node].send (('event', event_type, data, priority))
+        except (OSError, EOFError):
+            return False
+        return True
+
+    def stop (self, timeout=5.0):
+        with self.lock:
+            for name in self.outbound:
+                try:
+                    self.outbound[name].send (('stop',))
+                except (OSError, EOFError):
+                    pass
+        for name in self.processes:
+            process = self.processes[name]
+            process.join (timeout)
+            if process.is_alive ():
+                process.terminate ()
+                process.join ()
+        for name in self.outbound:
+            self.outbound[name].close ()
+        self.outbound = {}
+        return
+
+    def supervise (self):
+        # waits until any node stops (its handler returned False, or it failed), then stops the rest; returns the
+        # nodes' exit codes
+        if self.processes:
+            wait ([self.processes[name].sentinel for name in self.processes])
+        self.stop ()
+        codes = {}
+        for name in self.processes:
+            codes[name] = self.processes[name].exitcode
+        self.processes = {}
+        return codes
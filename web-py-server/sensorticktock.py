@@ -0,0 +1,160 @@
+# Sensor samplers in processes of their own, for ticktock.qController (Python 3.8+, numpy)
+#
+# A sampler calls sample() every interval seconds in a separate process - so that polling the sensors doesn't compete
+# for the GIL with the MQTT client and the controller - and writes each reading into a ring of frames in shared
+# memory. The controller's process reads the latest frame without copying it, typically in tock (). A reading that
+# can't wait for the next tock (e.g., an obstacle closer than some threshold) is also sent back through a pipe and
+# added to the controller's queue as a high-priority event.
+#
+# sample (and urgent) are called in the sampler's process, so must be picklable, i.e., defined at module level.
+
+import time
+import threading
+import multiprocessing
+
+try:
+    import numpy
+    from multiprocessing import shared_memory
+except ImportError:
+    numpy = None
+    shared_memory = None
+
+from ticktock import qClock, qPriorityHigh
+
+# shared memory layout: a header of int64 [frames written, stop flag], then slots x (1 + fields) float64 frames
+qSampler_header = 2
+
+def qSampler_views (shm, slots, fields):
+    header = numpy.ndarray ((qSampler_header,), numpy.int64, shm.buf)
+    frames = numpy.ndarray ((slots, 1 + fields), numpy.float64, shm.buf, qSampler_header * 8)
+    return header, frames
+
+def qSampler_run (shm_name, slots, fields, sample, interval, urgent, conn):
+    # the sampler process
+    shm = shared_memory.SharedMemory (name=shm_name)
+    header, frames = qSampler_views (shm, slots, fields)
+    bUrgent = False
+    frame = None # a view too, once there has been a reading
+    t_next = qClock ()
+    try:
+        while header[1] == 0:
+            values = sample ()
+            t = qClock ()
+            count = int (header[0])
+            frame = frames[count % slots]
+            frame[0] = t
+            frame[1:] = values
+            header[0] = count + 1 # publish the frame only once it has been written
+
+            if urgent is not None: # notify on the transition to urgent, not for every urgent reading
+                bNow = bool (urgent (values))
+                if bNow and not bUrgent:
+                    conn.send ((t, tuple (values)))
+                bUrgent = bNow
+
+            t_next += interval
+            delay = t_next - qClock ()
+            if delay > 0:
+                time.sleep (delay)
+            else: # overran; don't try to catch up
+                t_next = qClock ()
+    except (KeyboardInterrupt, BrokenPipeError):
+        pass
+    finally:
+        del header, frames, frame # the views must go before the memory can be closed
+        shm.close ()
+        conn.close ()
+    return
+
+class qSampler (object):
+    # sample () returns a sequence of fields numbers; urgent (values), if given, returns True for readings that should
+    # be added to the controller's queue straight away as event (urgent_event, values); by default urgent_event = name
+
+    def __init__ (self, controller, name, sample, interval, fields, slots=8, urgent=None, urgent_event=None):
+        if shared_memory is None:
+            raise ImportError ('qSampler requires numpy and multiprocessing.shared_memory (Python 3.8+)')
+        self.controller = controller
+        self.name = name
+        self.sample = sample
+        self.interval = interval
+        self.fields = fields
+        self.slots = slots # frames are overwritten this many readings later
+        self.urgent = urgent
+        self.urgent_event = urgent_event
+        if urgent_event is None:
+            self.urgent_event = name
+        self.shm = None
+        self.header = None
+        self.frames = None
+        self.process = None
+        self.listener = None
+        self.notified = 0
+        return
+
+    def start (self):
+        size = (qSampler_header + self.slots * (1 + self.fields)) * 8
+        self.shm = shared_memory.SharedMemory (create=True, size=size)
+        self.header, self.frames = qSampler_views (self.shm, self.slots, self.fields)
+        self.header[:] = 0
+
+        conn_recv, conn_send = multiprocessing.Pipe (False)
+        self.process = multiprocessing.Process (target=qSampler_run, name='sampler-' + self.name,
+                                                args=(self.shm.name, self.slots, self.fields, self.sample,
+                                                      self.interval, self.urgent, conn_send))
+        self.process.daemon = True
+        self.process.start ()
+        conn_send.close () # so that recv () sees EOF when the sampler exits
+
+        self.listener = threading.Thread (target=self.listen, args=(conn_recv,))
+        self.listener.daemon = True
+        self.listener.start ()
+        return
+
+    def listen (self, conn):
+        while True:
+            try:
+                t, values = conn.recv ()
+            except (EOFError, OSError):
+                break
+            self.notified += 1
+            self.controller.event (self.urgent_event, values, priority=qPriorityHigh)
+        conn.close ()
+        return
+
+    def stop (self):
+        if self.process is None:
+            return
+        self.header[1] = 1
+        self.process.join (max (1.0, 2 * self.interval))
+        if self.process.is_alive ():
+            self.process.terminate ()
+            self.process.join ()
+        self.listener.join ()
+        self.process = None
+        self.listener = None
+        self.header = None
+        self.frames = None
+        self.shm.close ()
+        self.shm.unlink ()
+        self.shm = None
+        return
+
+    def count (self):
+        # the number of readings written so far
+        return int (self.header[0])
+
+    def latest (self):
+        # returns (sequence, frame) for the most recent reading, or (-1, None) if there hasn't been one yet; frame is
+        # a view of shared memory ([t, values...]), which the sampler will overwrite in time - see valid ()
+        count = int (self.header[0])
+        if count == 0:
+            return -1, None
+        sequence = count - 1
+        return sequence, self.frames[sequence % self.slots]
+
+    def valid (self, sequence):
+        # True if the frame of reading sequence hasn't (yet) been overwritten; check after using it
+        return int (self.header[0]) - sequence < self.slots
+
+    def counters (self):
+        return { 'readings': self.count (), 'notified': self.notified }
@@ -1,4 +1,5 @@
 import os
+import json
 import web
 
 global_server_instance = 0
@@ -44,11 +45,24 @@ class server (object):
         response = ''
 
         if self.handler is not None:
-            self.handler.command (name, value)
+            if self.handler.command (name, value) == False: # the controller is falling behind; shed the load
+                web.ctx.status = '503 Service Unavailable'
 
         return response # There is no response - the command is handled asynchronously
 
     def special (self, name, value):
+        if name == 'stats': # controller queue/timing statistics; value=reset to start counting afresh
+            if self.handler is None:
+                return '{}'
+            web.header ('Content-Type', 'application/json')
+            return json.dumps (self.handler.stats (value == 'reset'))
+
+        if name == 'profile': # value=start to start sampling stacks, stop to stop; returns the stack counts so far
+            if self.handler is None:
+                return ''
+            web.header ('Content-Type', 'text/plain') # flame graph folded format, for flamegraph.pl or speedscope
+            return self.handler.profile (value)
+
         if name == 'stop':
             self.handler.stop ()
             self.app.stop ()
@@ -1,70 +1,1744 @@
+import os
+import sys
 import time
+import heapq
+import struct
+import pickle
+import itertools
 import threading
-from Queue import PriorityQueue
+
+from collections import deque
+
+try:
+    import numpy
+except ImportError: # only needed for qRing
+    numpy = None
+
+try:
+    qClock = time.monotonic
+except AttributeError: # Python 2 has no monotonic clock; fall back to wall-clock time
+    qClock = time.time
 
 qPriorityHigh   = 0
 qPriorityNormal = 1
 qPriorityLow    = 2
 
+# What a journal record (see qJournal) stands for:
+qJournalEvent = 0 # handler.event (name, data)
+qJournalTick  = 1 # handler.tock (data)
+qJournalTimer = 2 # the callback of the timer called name
+
+# What the tick scheduler does when tock() (or anything else) makes it miss one or more deadlines:
+qOverrunSkip     = 'skip'     # drop the missed deadlines; never more than one tick waiting in the queue
+qOverrunCatchUp  = 'catchup'  # queue one tick for every deadline, however late
+qOverrunCoalesce = 'coalesce' # queue one tick for all missed deadlines; tock() receives the number of periods
+
+# What a bounded queue does with a new event when it is full (see qController.limit ()):
+qOverflowDropOldest = 'drop-oldest' # drop the oldest event in the queue to make room
+qOverflowDropNewest = 'drop-newest' # drop the new event
+qOverflowBlock      = 'block'       # make the caller wait for room (up to a timeout, if given), then drop the new event
+qOverflowReject     = 'reject'      # refuse the new event; the caller gets False back and should shed load
+
+# Scheduling policies for the controller's threads (see qController.pin ())
+qSchedOther = 'other' # the normal time-sharing policy
+qSchedFIFO  = 'fifo'  # real-time: runs until it blocks, ahead of all time-sharing threads
+qSchedRR    = 'rr'    # real-time: like qSchedFIFO, but round-robin amongst threads of equal priority
+
+class qVirtualClock (object):
+    # Simulated time, for qController (..., clock=qVirtualClock ()). Like qClock, it is called for the time in
+    # seconds; but it only moves when the controller, having nothing left to do, jumps it straight to the next timer
+    # deadline (see qVirtualScheduler). Ticks and timers therefore fire as fast as they can be handled, in the order
+    # and with the timestamps they would have had in real time - for tests and soak runs faster than real time.
+
+    def __init__ (self, start=0.0):
+        self.t = start
+        return
+
+    def __call__ (self):
+        return self.t
+
+    def advance (self, t):
+        if self.t < t:
+            self.t = t
+        return
+
 class qData (object):
-    def __init__ (self, event_type, data=None, handler=None):
+    def __init__ (self, event_type, data=None, handler=None, t_queued=None):
         self.event_type = event_type
         self.event_data = data
+        self.t_queued = t_queued
+        if t_queued is None:
+            self.t_queued = qClock ()
+        self.deadline = None # if set, the event is dropped instead of being dispatched after this time
+        self.t_due = None    # for a tick, the timer deadline that it is for
         self.event_handler = handler
         return
 
-def qController_tick (queue_controller):
-    queue_controller.tick ()
+class qHistogram (object):
+    # Fixed-size histogram of durations in seconds, with power-of-two buckets in microseconds: bucket i counts
+    # durations of less than 2**i microseconds (and at least 2**(i-1)); the last bucket also counts anything longer.
+
+    def __init__ (self, buckets=25): # 2**24 microseconds is about 17 seconds
+        self.counts = [0] * buckets
+        self.reset ()
+        return
+
+    def reset (self):
+        for i in range (0, len (self.counts)):
+            self.counts[i] = 0
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        return
+
+    def add (self, value):
+        i = int (value * 1000000)
+        if i > 0:
+            i = i.bit_length ()
+            if i >= len (self.counts):
+                i = len (self.counts) - 1
+        else:
+            i = 0
+        self.counts[i] += 1
+        self.count += 1
+        self.total += value
+        if self.max < value:
+            self.max = value
+        return
+
+    def percentile (self, p):
+        # upper bound of the bucket containing the p-th percentile (0 < p <= 100)
+        if self.count == 0:
+            return 0.0
+        target = self.count * p / 100.0
+        running = 0
+        for i in range (0, len (self.counts)):
+            running += self.counts[i]
+            if running >= target:
+                break
+        return min ((1 << i) / 1000000.0, self.max)
+
+    def snapshot (self):
+        mean = 0.0
+        if self.count > 0:
+            mean = self.total / self.count
+        return { 'count': self.count, 'mean': mean, 'max': self.max,
+                 'p50': self.percentile (50), 'p90': self.percentile (90), 'p99': self.percentile (99) }
+
+class qStats (object):
+    # Queue latency (enqueue to dispatch) per priority, handler run times, tick jitter and queue depth, in fixed memory
+
+    def __init__ (self, timer_interval):
+        self.timer_interval = timer_interval
+        self.priority_names = { qPriorityHigh: 'high', qPriorityNormal: 'normal', qPriorityLow: 'low' }
+        self.latency = {}
+        for p in self.priority_names:
+            self.latency[p] = qHistogram ()
+        self.run_tock  = qHistogram ()
+        self.run_event = qHistogram ()
+        self.jitter = qHistogram () # |time between successive tocks - timer_interval|
+        self.t_tock = None
+        self.depth_max = 0
+        self.lock = threading.Lock () # handlers may run on several threads (see qDispatchPool)
+        return
+
+    def reset (self):
+        with self.lock:
+            for p in self.latency:
+                self.latency[p].reset ()
+            self.run_tock.reset ()
+            self.run_event.reset ()
+            self.jitter.reset ()
+            self.depth_max = 0
+        return
+
+    def queued (self, depth):
+        if self.depth_max < depth:
+            self.depth_max = depth
+        return
+
+    def dispatched (self, priority, latency):
+        with self.lock:
+            h = self.latency.get (priority)
+            if h is None:
+                h = qHistogram ()
+                self.latency[priority] = h
+            h.add (latency)
+        return
+
+    def ticked (self, t_now, interval=None):
+        if interval is None:
+            interval = self.timer_interval
+        with self.lock:
+            if self.t_tock is not None:
+                self.jitter.add (abs (t_now - self.t_tock - interval))
+            self.t_tock = t_now
+        return
+
+    def handled (self, bTock, run_time):
+        with self.lock:
+            if bTock:
+                self.run_tock.add (run_time)
+            else:
+                self.run_event.add (run_time)
+        return
+
+    def snapshot (self):
+        with self.lock:
+            latency = {}
+            for p in self.latency:
+                latency[self.priority_names.get (p, str (p))] = self.latency[p].snapshot ()
+            return { 'latency': latency,
+                     'run': { 'tock': self.run_tock.snapshot (), 'event': self.run_event.snapshot () },
+                     'jitter': self.jitter.snapshot (),
+                     'depth_max': self.depth_max }
+
+class qTimer (object):
+    # A periodic timer; each time it is due, the scheduler asks it to add a tick to the controller's queue.
+    # The callback is called (on the controller's thread) as the tick is dispatched; with callback=None the tick is
+    # for the controller's own handler, i.e., handler.tock ().
+
+    def __init__ (self, queue_controller, name, interval, callback=None, overrun=qOverrunSkip, late_tolerance=None):
+        if overrun not in (qOverrunSkip, qOverrunCatchUp, qOverrunCoalesce):
+            raise ValueError ('unknown overrun policy: ' + str (overrun))
+        self.controller = queue_controller
+        self.name = name
+        self.interval = interval
+        self.callback = callback
+        self.overrun = overrun
+        self.bDefaultTolerance = (late_tolerance is None)
+        if late_tolerance is None:
+            late_tolerance = interval / 10.0
+        self.late_tolerance = late_tolerance
+
+        self.ticks  = 0 # number of ticks added to the queue
+        self.missed = 0 # number of deadlines dropped (skip) or folded into another tick (coalesce)
+        self.late   = 0 # number of ticks dispatched more than late_tolerance after their deadline (see qController)
+
+        self.lock = threading.Lock ()
+        self.bActive = True
+        self.deadline = 0
+        self.due = 0     # the latest deadline that has passed, as of advance ()
+        self.pending = 0 # ticks in the queue that haven't been dispatched yet
+        self.count = 0   # coalesce: the number of periods that the waiting tick stands for
+        return
+
+    def counters (self):
+        return { 'ticks': self.ticks, 'missed': self.missed, 'late': self.late, 'interval': self.interval }
+
+    def retime (self, interval):
+        # the new interval applies from the deadline after next (see the scheduler's reschedule ())
+        self.interval = interval
+        if self.bDefaultTolerance:
+            self.late_tolerance = interval / 10.0
+        return
+
+    def reset (self, now):
+        with self.lock:
+            self.pending = 0
+            self.count = 0
+        self.deadline = now + self.interval
+        return
+
+    def advance (self, now):
+        # fixed-rate deadlines, so that the period doesn't drift; returns the number of deadlines that have passed
+        count = 1 + int ((now - self.deadline) / self.interval)
+        self.due = self.deadline + (count - 1) * self.interval
+        self.deadline += count * self.interval
+        return count
+
+    def take (self, q):
+        # called by the controller as it dispatches a tick; returns the value to pass to tock() or the callback
+        with self.lock:
+            self.pending -= 1
+            if self.overrun == qOverrunCoalesce:
+                count = self.count
+                self.count = 0
+                return count
+        return None
+
+    def deliver (self, count):
+        # count is the number of deadlines that have passed since the last delivery (at least 1)
+        queue = 0
+        with self.lock:
+            if self.overrun == qOverrunCatchUp:
+                queue = count
+
+            elif self.overrun == qOverrunCoalesce:
+                if self.pending > 0:
+                    self.count += count
+                    self.missed += count
+                else:
+                    self.count = count
+                    self.missed += count - 1
+                    queue = 1
+
+            else: # qOverrunSkip
+                if self.pending > 0:
+                    self.missed += count
+                else:
+                    self.missed += count - 1
+                    queue = 1
+
+            self.pending += queue
+            self.ticks += queue
+
+        due = self.due
+        for i in range (0, queue): # catch-up: one tick for each deadline, oldest first
+            self.controller.tick (self, due - (queue - 1 - i) * self.interval)
+        return
+
+class qThreadSettings (object):
+    # CPU affinity and scheduling policy for one of the controller's threads. apply () is called on the thread itself
+    # as it starts, and records (and reports) what actually took effect: where the OS doesn't support a setting, or
+    # doesn't permit it (real-time policies usually need root or CAP_SYS_NICE), the thread carries on without it.
+
+    def __init__ (self, name, cpus=None, policy=None, priority=None):
+        if policy is not None and policy not in (qSchedOther, qSchedFIFO, qSchedRR):
+            raise ValueError ('unknown scheduling policy: ' + str (policy))
+        self.name = name
+        self.cpus = cpus         # e.g., [3]; None to leave as is
+        self.policy = policy     # qSched*; None to leave as is
+        self.priority = priority # for qSchedFIFO and qSchedRR; None for the lowest
+        self.effective = None
+        return
+
+    def apply (self):
+        errors = []
+        if self.cpus is not None:
+            if hasattr (os, 'sched_setaffinity'):
+                try:
+                    os.sched_setaffinity (0, self.cpus) # on Linux, 0 is the calling thread
+                except (OSError, ValueError) as e:
+                    errors.append ('affinity: ' + str (e))
+            else:
+                errors.append ('affinity: not supported')
+        if self.policy is not None:
+            if hasattr (os, 'sched_setscheduler'):
+                policy = getattr (os, 'SCHED_' + self.policy.upper ())
+                priority = self.priority
+                if priority is None:
+                    priority = os.sched_get_priority_min (policy)
+                try:
+                    os.sched_setscheduler (0, policy, os.sched_param (priority))
+                except (OSError, ValueError) as e:
+                    errors.append ('policy: ' + str (e))
+            else:
+                errors.append ('policy: not supported')
+
+        effective = qThread_describe ()
+        effective['errors'] = errors
+        self.effective = effective
+        text = 'ticktock: ' + self.name + ' thread: cpus=' + str (effective['cpus']) + ', policy=' + str (effective['policy'])
+        text += ', priority=' + str (effective['priority'])
+        if errors:
+            text += ' (not applied: ' + '; '.join (errors) + ')'
+        print (text)
+        return effective
+
+def qThread_describe ():
+    # the calling thread's CPU affinity and scheduling policy, as far as the OS will tell
+    cpus = None
+    if hasattr (os, 'sched_getaffinity'):
+        cpus = sorted (os.sched_getaffinity (0))
+    policy = None
+    priority = None
+    if hasattr (os, 'sched_getscheduler'):
+        p = os.sched_getscheduler (0)
+        for name in (qSchedOther, qSchedFIFO, qSchedRR):
+            if p == getattr (os, 'SCHED_' + name.upper (), None):
+                policy = name
+        if policy is None:
+            policy = str (p)
+        priority = os.sched_getparam (0).sched_priority
+    return { 'cpus': cpus, 'policy': policy, 'priority': priority }
+
+class qScheduler (object):
+    # One thread serving any number of timers, kept in a heap ordered by deadline.
+
+    def __init__ (self, clock=qClock):
+        self.clock = clock
+        self.cv = threading.Condition ()
+        self.heap = []
+        self.sequence = itertools.count ()
+        self.bRunning = False
+        self.thread = None
+        self.settings = None # qThreadSettings for the scheduler's thread
+        return
+
+    def add (self, timer):
+        with self.cv:
+            timer.reset (self.clock ())
+            heapq.heappush (self.heap, (timer.deadline, next (self.sequence), timer))
+            self.cv.notify ()
+        return
+
+    def remove (self, timer):
+        with self.cv:
+            timer.bActive = False # it will be discarded when it reaches the top of the heap
+        return
+
+    def start (self):
+        with self.cv:
+            now = self.clock ()
+            timers = []
+            for entry in self.heap: # a rescheduled timer may have more than one entry
+                if entry[2].bActive and entry[2] not in timers:
+                    timers.append (entry[2])
+            self.heap = []
+            for timer in timers:
+                timer.reset (now)
+                self.heap.append ((timer.deadline, next (self.sequence), timer))
+            heapq.heapify (self.heap)
+            self.bRunning = True
+        self.thread = threading.Thread (target=self.run)
+        self.thread.daemon = True
+        self.thread.start ()
+        return
+
+    def stop (self):
+        with self.cv:
+            self.bRunning = False
+            self.cv.notify ()
+        if self.thread is not None and self.thread is not threading.current_thread ():
+            self.thread.join ()
+        self.thread = None
+        return
+
+    def reschedule (self, timer, deadline):
+        # brings the timer's next deadline forward (or back) to deadline
+        with self.cv:
+            timer.deadline = deadline
+            heapq.heappush (self.heap, (deadline, next (self.sequence), timer))
+            self.cv.notify ()
+        return
+
+    def run (self):
+        if self.settings is not None:
+            self.settings.apply ()
+        while True:
+            due = []
+            with self.cv:
+                while self.bRunning and not due:
+                    if not self.heap:
+                        self.cv.wait ()
+                        continue
+                    deadline, s, timer = self.heap[0]
+                    if not timer.bActive or deadline != timer.deadline: # removed, or rescheduled
+                        heapq.heappop (self.heap)
+                        continue
+                    delay = deadline - self.clock ()
+                    if delay > 0:
+                        self.cv.wait (delay)
+                        continue
+                    now = self.clock ()
+                    while self.heap and self.heap[0][0] <= now:
+                        deadline, s, timer = heapq.heappop (self.heap)
+                        if timer.bActive and deadline == timer.deadline:
+                            due.append ((timer, timer.advance (now)))
+                            heapq.heappush (self.heap, (timer.deadline, next (self.sequence), timer))
+                if not self.bRunning:
+                    break
+
+            for timer, count in due: # outside the lock, in case the queue makes us wait
+                timer.deliver (count)
+        return
+
+class qVirtualScheduler (object):
+    # Serves the timers on virtual time (see qVirtualClock): nothing is due until the controller calls advance ().
+
+    def __init__ (self, clock):
+        self.clock = clock
+        self.lock = threading.Lock ()
+        self.heap = []
+        self.sequence = itertools.count ()
+        self.settings = None # there's no thread of its own to apply qThreadSettings to
+        return
+
+    def add (self, timer):
+        with self.lock:
+            timer.reset (self.clock ())
+            heapq.heappush (self.heap, (timer.deadline, next (self.sequence), timer))
+        return
+
+    def remove (self, timer):
+        timer.bActive = False # it will be discarded when it reaches the top of the heap
+        return
+
+    def start (self):
+        with self.lock:
+            now = self.clock ()
+            timers = []
+            for entry in self.heap: # a rescheduled timer may have more than one entry
+                if entry[2].bActive and entry[2] not in timers:
+                    timers.append (entry[2])
+            self.heap = []
+            for timer in timers:
+                timer.reset (now)
+                self.heap.append ((timer.deadline, next (self.sequence), timer))
+            heapq.heapify (self.heap)
+        return
+
+    def stop (self):
+        return
+
+    def reschedule (self, timer, deadline):
+        with self.lock:
+            timer.deadline = deadline
+            heapq.heappush (self.heap, (deadline, next (self.sequence), timer))
+        return
+
+    def advance (self):
+        # moves the clock on to the next deadline (unless it is already past it) and delivers every timer then due;
+        # False if there are no timers
+        due = []
+        with self.lock:
+            while self.heap and (not self.heap[0][2].bActive or self.heap[0][0] != self.heap[0][2].deadline):
+                heapq.heappop (self.heap)
+            if not self.heap:
+                return False
+            now = max (self.heap[0][0], self.clock ()) # a handler may have moved the clock on (e.g., a slow tock)
+            self.clock.advance (now)
+            while self.heap and self.heap[0][0] <= now:
+                deadline, s, timer = heapq.heappop (self.heap)
+                if timer.bActive and deadline == timer.deadline:
+                    due.append ((timer, timer.advance (now)))
+                    heapq.heappush (self.heap, (timer.deadline, next (self.sequence), timer))
+        for timer, count in due:
+            timer.deliver (count)
+        return True
+
+class qPriorityClass (object):
+    # Everything queued with the same priority. A waiting item's effective priority is its class's priority less
+    # aging times the number of seconds it has waited, so that the longer it waits the sooner it is dispatched (lower
+    # is more urgent); and once it has waited max_delay seconds, it is dispatched before anything else.
+
+    def __init__ (self, priority, name=None, aging=0.0, max_delay=None):
+        if name is None:
+            name = str (priority)
+        self.priority = priority
+        self.name = name
+        self.aging = aging         # priority levels per second
+        self.max_delay = max_delay # seconds, or None for no limit
+        self.heap = []             # (deadline, sequence, bEvent, qData)
+
+        self.promoted = 0   # dispatched ahead of a class of higher priority, because of aging or max_delay
+        self.overdue = 0    # dispatched after waiting longer than max_delay
+        self.wait_max = 0.0 # longest wait before dispatch
+        return
+
+    def counters (self):
+        return { 'priority': self.priority, 'aging': self.aging, 'max_delay': self.max_delay, 'waiting': len (self.heap),
+                 'promoted': self.promoted, 'overdue': self.overdue, 'wait_max': self.wait_max }
+
+class qQueue (object):
+    # The controller's priority queue. Items are kept per priority class (see qPriorityClass); the class whose oldest
+    # waiting item has the lowest effective priority goes next. Within each class, events are dispatched earliest-
+    # deadline-first; events without a deadline of their own are given an implicit one, slack seconds after they were
+    # queued, so that they are first-in, first-out amongst themselves and can't be held back forever. Events whose
+    # deadline has passed are dropped (and counted) instead of being dispatched.
+    # The queue is optionally bounded. The capacity applies only to events; stop requests and ticks (of which each
+    # timer has at most a few waiting) always get in.
+
+    def __init__ (self):
+        self.cv = threading.Condition ()
+        self.classes = {} # priority -> qPriorityClass
+        self.length = 0
+        self.slack = 1.0
+        self.sequence = itertools.count ()
+        self.events = 0 # number of events (as opposed to ticks and stop requests) in the queue
+
+        self.capacity = 0 # 0 for no limit
+        self.overflow = qOverflowDropOldest
+        self.timeout = None
+        self.on_drop = None # called with each event dropped or refused, while the queue is locked
+        self.bClosed = False # once the controller has stopped, producers waiting for room give up; see close ()
+        self.clock = qClock # for deadlines and waiting times; see qController's clock
+
+        self.dropped_oldest = 0
+        self.dropped_newest = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.expired = 0
+        return
+
+    def priority_class (self, priority, name=None, aging=0.0, max_delay=None):
+        with self.cv:
+            c = self.classes.get (priority)
+            if c is None:
+                c = qPriorityClass (priority, name, aging, max_delay)
+                self.classes[priority] = c
+            else:
+                if name is not None:
+                    c.name = name
+                c.aging = aging
+                c.max_delay = max_delay
+        return c
+
+    def limit (self, capacity, overflow=qOverflowDropOldest, timeout=None):
+        if overflow not in (qOverflowDropOldest, qOverflowDropNewest, qOverflowBlock, qOverflowReject):
+            raise ValueError ('unknown overflow policy: ' + str (overflow))
+        with self.cv:
+            self.capacity = capacity
+            self.overflow = overflow
+            self.timeout = timeout
+            self.cv.notify_all ()
+        return
+
+    def __len__ (self):
+        return self.length
+
+    def load (self):
+        # events in the queue as a fraction of its capacity (0 if unbounded)
+        if self.capacity > 0:
+            return self.events / float (self.capacity)
+        return 0.0
+
+    def counters (self):
+        with self.cv:
+            classes = {}
+            for c in self.classes.values ():
+                classes[c.name] = c.counters ()
+            return { 'depth': self.length, 'events': self.events, 'capacity': self.capacity,
+                     'dropped_oldest': self.dropped_oldest, 'dropped_newest': self.dropped_newest,
+                     'rejected': self.rejected, 'timeouts': self.timeouts, 'expired': self.expired,
+                     'classes': classes }
+
+    def full (self):
+        return self.capacity > 0 and self.events >= self.capacity
+
+    def drop (self, q):
+        if self.on_drop is not None:
+            self.on_drop (q)
+        return
+
+    def evict_oldest (self):
+        oldest = None
+        for c in self.classes.values ():
+            for i in range (0, len (c.heap)):
+                if c.heap[i][2] and (oldest is None or c.heap[i][1] < oldest[0].heap[oldest[1]][1]):
+                    oldest = (c, i)
+        if oldest is None:
+            return False
+        c, i = oldest
+        entry = c.heap[i]
+        c.heap[i] = c.heap[-1]
+        c.heap.pop ()
+        heapq.heapify (c.heap)
+        self.length -= 1
+        self.events -= 1
+        self.dropped_oldest += 1
+        self.drop (entry[3])
+        return True
+
+    def put (self, priority, q, bEvent=True, bMayBlock=True):
+        # returns False if the event was dropped or refused because the queue is full
+        with self.cv:
+            if bEvent and self.full ():
+                if self.overflow == qOverflowDropOldest:
+                    self.evict_oldest ()
+
+                elif self.overflow == qOverflowBlock and bMayBlock:
+                    if self.timeout is None:
+                        while self.full () and not self.bClosed:
+                            self.cv.wait ()
+                    else:
+                        t_end = qClock () + self.timeout
+                        while self.full () and not self.bClosed:
+                            remaining = t_end - qClock ()
+                            if remaining <= 0:
+                                self.timeouts += 1
+                                self.drop (q)
+                                return False
+                            self.cv.wait (remaining)
+                    if self.bClosed: # nobody is taking events any more, so there will never be room
+                        self.rejected += 1
+                        self.drop (q)
+                        return False
+
+                elif self.overflow == qOverflowDropNewest:
+                    self.dropped_newest += 1
+                    self.drop (q)
+                    return False
+
+                else: # qOverflowReject, or qOverflowBlock where the caller mustn't wait
+                    self.rejected += 1
+                    self.drop (q)
+                    return False
+
+            c = self.classes.get (priority)
+            if c is None:
+                c = qPriorityClass (priority)
+                self.classes[priority] = c
+            deadline = q.deadline
+            if deadline is None:
+                deadline = q.t_queued + self.slack
+            heapq.heappush (c.heap, (deadline, next (self.sequence), bEvent, q))
+            self.length += 1
+            if bEvent:
+                self.events += 1
+            self.cv.notify_all ()
+        return True
+
+    def select (self, now):
+        # the class to take from next: overdue (waited max_delay or more) first, then lowest effective priority,
+        # then whichever has been waiting longest
+        best = None
+        best_key = None
+        top = None
+        for c in self.classes.values ():
+            if not c.heap:
+                continue
+            if top is None or c.priority < top:
+                top = c.priority
+            t_queued = c.heap[0][3].t_queued
+            waited = now - t_queued
+            if c.max_delay is not None and waited >= c.max_delay:
+                key = (0, 0, t_queued)
+            else:
+                key = (1, c.priority - c.aging * waited, t_queued)
+            if best_key is None or key < best_key:
+                best = c
+                best_key = key
+        if best is not None and best.priority > top:
+            best.promoted += 1
+        return best
+
+    def take (self):
+        # returns the next (priority, qData), or None if there is nothing left that hasn't expired
+        while self.length > 0:
+            now = self.clock ()
+            c = self.select (now)
+            d, s, bEvent, q = heapq.heappop (c.heap)
+            self.length -= 1
+            if bEvent:
+                self.events -= 1
+                if self.capacity > 0:
+                    self.cv.notify_all () # a producer may be waiting for space
+            if q.deadline is not None and q.deadline < now:
+                self.expired += 1
+                self.drop (q)
+                continue
+            waited = now - q.t_queued
+            if c.wait_max < waited:
+                c.wait_max = waited
+            if c.max_delay is not None and waited > c.max_delay:
+                c.overdue += 1
+            return c.priority, q
+        return None
+
+    def take_matching (self, match):
+        # removes every waiting event for which match (qData) is true, and returns those that haven't expired as a list
+        # of (priority, qData), in the order in which they would have been dispatched
+        with self.cv:
+            now = self.clock ()
+            found = []
+            for c in self.classes.values ():
+                keep = []
+                for entry in c.heap:
+                    if entry[2] and match (entry[3]):
+                        found.append ((entry[0], entry[1], c, entry[3]))
+                    else:
+                        keep.append (entry)
+                if len (keep) < len (c.heap):
+                    heapq.heapify (keep)
+                    c.heap = keep
+            if not found:
+                return found
+            found.sort (key=lambda entry: (entry[2].priority, entry[0], entry[1]))
+            self.length -= len (found)
+            self.events -= len (found)
+            if self.capacity > 0:
+                self.cv.notify_all ()
+            items = []
+            for d, s, c, q in found:
+                if q.deadline is not None and q.deadline < now:
+                    self.expired += 1
+                    self.drop (q)
+                    continue
+                waited = now - q.t_queued
+                if c.wait_max < waited:
+                    c.wait_max = waited
+                items.append ((c.priority, q))
+            return items
+
+    def get (self):
+        with self.cv:
+            while True:
+                while self.length == 0:
+                    self.cv.wait ()
+                item = self.take ()
+                if item is not None:
+                    return item
+
+    def get_nowait (self):
+        # returns None if the queue is empty
+        with self.cv:
+            if self.length == 0:
+                return None
+            return self.take ()
+
+    def clear (self):
+        with self.cv:
+            for c in self.classes.values ():
+                c.heap = []
+            self.length = 0
+            self.events = 0
+            self.cv.notify_all ()
+        return
+
+    def open (self):
+        with self.cv:
+            self.bClosed = False
+        return
+
+    def close (self):
+        # wakes any producers waiting for room (under qOverflowBlock) and refuses their events
+        with self.cv:
+            self.bClosed = True
+            self.cv.notify_all ()
+        return
+
+class qCoalescer (object):
+    # Last-value-wins: while an event of a coalesced type is still waiting in the queue, a newer event of the same
+    # type replaces its value instead of being queued behind it.
+
+    def __init__ (self):
+        self.lock = threading.Lock ()
+        self.types = set ()
+        self.pending = {} # event_type -> the qData waiting in the queue
+        self.folded = {}  # event_type -> number of events folded into a waiting event
+        return
+
+    def coalesce (self, event_type, enable=True):
+        with self.lock:
+            if enable:
+                self.types.add (event_type)
+                self.folded.setdefault (event_type, 0)
+            else:
+                self.types.discard (event_type)
+                self.pending.pop (event_type, None)
+        return
+
+    def fold (self, q):
+        # returns True if q has been folded into a waiting event, and so must not be queued
+        if q.event_type not in self.types:
+            return False
+        with self.lock:
+            if q.event_type not in self.types:
+                return False
+            p = self.pending.get (q.event_type)
+            if p is None:
+                self.pending[q.event_type] = q
+                return False
+            p.event_data = q.event_data
+            p.deadline = q.deadline
+            self.folded[q.event_type] += 1
+        return True
+
+    def take (self, q):
+        # called as q is dispatched; returns its (latest) value
+        if q.event_type not in self.pending:
+            return q.event_data
+        with self.lock:
+            if self.pending.get (q.event_type) is q:
+                del self.pending[q.event_type]
+            return q.event_data
+
+    def discard (self, q):
+        # q has been dropped from the queue, so mustn't have anything more folded into it
+        if q.event_type not in self.pending:
+            return
+        with self.lock:
+            if self.pending.get (q.event_type) is q:
+                del self.pending[q.event_type]
+        return
+
+    def clear (self):
+        with self.lock:
+            self.pending = {}
+        return
+
+    def total_folded (self):
+        with self.lock:
+            return sum (self.folded.values ())
+
+class qDispatchPool (object):
+    # Runs the handlers on a bounded set of worker threads instead of the controller's own thread. Events with the
+    # same key (by default the event type, e.g., the MQTT topic) are dispatched one at a time and strictly in order;
+    # events with different keys may run concurrently. Ticks have a lane and a thread of their own, so that they
+    # can't be starved by slow event handlers. NOTE: the handlers must then be thread-safe.
+
+    def __init__ (self, queue_controller, workers, key=None, backlog=None):
+        self.controller = queue_controller
+        self.workers = workers
+        self.key = key # key (event_type, event_data) -> dispatch key
+        if backlog is None:
+            backlog = 4 * workers
+        self.backlog_max = backlog # events handed over but not yet dispatched; beyond this, wait for the workers
+
+        self.cv = threading.Condition ()
+        self.lanes = {}        # key -> deque of (priority, q); the head is the event being (or next to be) dispatched
+        self.ready = deque ()  # keys with work to do but no worker
+        self.backlog = 0
+        self.tick_cv = threading.Condition ()
+        self.ticks = deque ()
+        self.bRunning = False
+        self.threads = []
+        return
+
+    def start (self):
+        with self.cv:
+            self.lanes = {}
+            self.ready = deque ()
+            self.backlog = 0
+            self.bRunning = True
+        with self.tick_cv:
+            self.ticks = deque ()
+        self.threads = []
+        for i in range (0, self.workers):
+            self.threads.append (threading.Thread (target=self.work))
+        self.threads.append (threading.Thread (target=self.work_ticks))
+        for t in self.threads:
+            t.daemon = True
+            t.start ()
+        return
+
+    def stop (self):
+        # waits for handlers already running to return; anything still waiting is dropped
+        with self.cv:
+            self.bRunning = False
+            self.cv.notify_all ()
+        with self.tick_cv:
+            self.tick_cv.notify_all ()
+        for t in self.threads:
+            if t is not threading.current_thread ():
+                t.join ()
+        self.threads = []
+        return
+
+    def interrupt (self):
+        # wakes a submit() that is waiting for the backlog to clear, e.g., so that the controller can see a stop
+        with self.cv:
+            self.cv.notify_all ()
+        return
+
+    def submit (self, priority, q):
+        if q.event_type == 'tick':
+            with self.tick_cv:
+                self.ticks.append ((priority, q))
+                self.tick_cv.notify ()
+            return
+
+        if self.key is None:
+            key = q.event_type
+        else:
+            key = self.key (q.event_type, q.event_data)
+
+        with self.cv:
+            if self.bRunning and self.backlog >= self.backlog_max:
+                self.cv.wait ()
+            if not self.bRunning:
+                return
+            self.backlog += 1
+            lane = self.lanes.get (key)
+            if lane is None:
+                self.lanes[key] = deque ([(priority, q)])
+                self.ready.append (key)
+                self.cv.notify_all ()
+            else:
+                lane.append ((priority, q))
+        return
+
+    def work (self):
+        self.controller.thread_setup ('workers')
+        while True:
+            with self.cv:
+                while self.bRunning and not self.ready:
+                    self.cv.wait ()
+                if not self.bRunning:
+                    break
+                key = self.ready.popleft ()
+                priority, q = self.lanes[key][0]
+
+            bContinue = self.controller.dispatch (priority, q)
+
+            with self.cv:
+                self.backlog -= 1
+                lane = self.lanes.get (key)
+                if lane is not None:
+                    lane.popleft ()
+                    if lane:
+                        self.ready.append (key) # to the back, so that one busy key can't hog the workers
+                    else:
+                        del self.lanes[key]
+                self.cv.notify_all ()
+
+            if not bContinue:
+                self.controller.stop ()
+        self.controller.thread_exit ()
+        return
+
+    def work_ticks (self):
+        self.controller.thread_setup ('workers')
+        while True:
+            with self.tick_cv:
+                while self.bRunning and not self.ticks:
+                    self.tick_cv.wait ()
+                if not self.bRunning:
+                    break
+                priority, q = self.ticks.popleft ()
+
+            if not self.controller.dispatch (priority, q):
+                self.controller.stop ()
+        self.controller.thread_exit ()
+        return
+
+class qJournal (object):
+    # Append-only binary journal of everything dispatched to the handler, for offline replay (see qReplay). The
+    # controller's thread only appends to a buffer; a background thread encodes the records and writes them out.
+    #
+    # File format: the magic bytes, then for each record a header (time in seconds since the journal was started,
+    # priority, kind, payload encoding, name length, payload length) followed by the UTF-8 name and the payload.
+
+    magic = b'TTJ2'
+    header = struct.Struct ('<ddBBHI') # priority is a double, as it may be any number (see qController.event ())
+
+    def __init__ (self, path, flush_interval=0.5, max_buffer=100000, clock=qClock):
+        self.path = path
+        self.file = open (path, 'wb')
+        self.file.write (self.magic)
+        self.t_start = clock () # record times are in the controller's clock
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.buffer = deque ()
+        self.records = 0
+        self.dropped = 0 # records lost because the writer couldn't keep up, or couldn't encode them
+        self.halt = threading.Event ()
+        self.thread = threading.Thread (target=self.run)
+        self.thread.daemon = True
+        self.thread.start ()
+        return
+
+    def record (self, t, priority, kind, name, data):
+        if len (self.buffer) < self.max_buffer:
+            self.buffer.append ((t - self.t_start, priority, kind, name, data))
+        else:
+            self.dropped += 1
+        return
+
+    def flush (self):
+        chunks = []
+        while self.buffer:
+            t, priority, kind, name, data = self.buffer.popleft ()
+            try:
+                encoding, payload = qJournal_encode (data)
+                name = name.encode ('utf-8')
+                header = self.header.pack (t, priority, kind, encoding, len (name), len (payload))
+            except (struct.error, TypeError, ValueError, AttributeError, pickle.PicklingError): # e.g., unpicklable data
+                self.dropped += 1
+                continue
+            chunks.append (header)
+            chunks.append (name)
+            chunks.append (payload)
+            self.records += 1
+        if chunks:
+            self.file.write (b''.join (chunks))
+            self.file.flush ()
+        return
+
+    def run (self):
+        while not self.halt.wait (self.flush_interval):
+            self.flush ()
+        return
+
+    def close (self):
+        self.halt.set ()
+        if self.thread is not threading.current_thread ():
+            self.thread.join ()
+        self.flush ()
+        self.file.close ()
+        return
+
+qJournalEncodingNone   = 0
+qJournalEncodingBytes  = 1
+qJournalEncodingText   = 2
+qJournalEncodingInt    = 3
+qJournalEncodingFloat  = 4
+qJournalEncodingPickle = 5
+
+try:
+    qJournal_text = unicode
+except NameError: # Python 3
+    qJournal_text = str
+
+def qJournal_encode (data):
+    if data is None:
+        return qJournalEncodingNone, b''
+    if isinstance (data, bytes):
+        return qJournalEncodingBytes, data
+    if isinstance (data, qJournal_text):
+        return qJournalEncodingText, data.encode ('utf-8')
+    if isinstance (data, int) and not isinstance (data, bool):
+        return qJournalEncodingInt, struct.pack ('<q', data)
+    if isinstance (data, float):
+        return qJournalEncodingFloat, struct.pack ('<d', data)
+    return qJournalEncodingPickle, pickle.dumps (data, 2)
+
+def qJournal_decode (encoding, payload):
+    if encoding == qJournalEncodingNone:
+        return None
+    if encoding == qJournalEncodingBytes:
+        return payload
+    if encoding == qJournalEncodingText:
+        return payload.decode ('utf-8')
+    if encoding == qJournalEncodingInt:
+        return struct.unpack ('<q', payload)[0]
+    if encoding == qJournalEncodingFloat:
+        return struct.unpack ('<d', payload)[0]
+    return pickle.loads (payload)
+
+def qJournal_read (path):
+    # generates (time, priority, kind, name, data) for each record in the journal
+    header = qJournal.header
+    with open (path, 'rb') as f:
+        if f.read (len (qJournal.magic)) != qJournal.magic:
+            raise ValueError ('not a ticktock journal: ' + path)
+        while True:
+            h = f.read (header.size)
+            if len (h) < header.size:
+                break
+            t, priority, kind, encoding, name_length, payload_length = header.unpack (h)
+            if priority == int (priority):
+                priority = int (priority)
+            name = f.read (name_length).decode ('utf-8')
+            payload = f.read (payload_length)
+            if len (payload) < payload_length: # the journal was cut short
+                break
+            yield t, priority, kind, name, qJournal_decode (encoding, payload)
     return
 
+class qReplay (object):
+    # Feeds a recorded journal back into a controller's handler (and its named timers, where the names match) on
+    # virtual time, as fast as possible, collecting handler run times as qController.snapshot () would.
+
+    def __init__ (self, path):
+        self.path = path
+        self.now = 0.0 # virtual time: the recorded time of the record being replayed
+        return
+
+    def run (self, queue_controller):
+        # returns a summary of the replay, including handler run time histograms
+        handler = queue_controller.controller
+        stats = qStats (queue_controller.timer_interval)
+        count = 0
+        skipped = 0
+        t_begin = qClock ()
+        for t, priority, kind, name, data in qJournal_read (self.path):
+            self.now = t
+            if isinstance (queue_controller.clock, qVirtualClock): # so that the handler sees the recorded times
+                queue_controller.clock.advance (t)
+            t_start = qClock ()
+            if kind == qJournalTick:
+                bContinue = handler.tock (data)
+            elif kind == qJournalTimer:
+                timer = queue_controller.timers.get (name)
+                if timer is None:
+                    skipped += 1
+                    continue
+                bContinue = timer.callback (data)
+            else:
+                route = queue_controller.handlers.get (name)
+                if route is None:
+                    bContinue = handler.event (name, data)
+                elif route[1]: # batched; the journal has each event separately
+                    bContinue = route[0] ([data])
+                else:
+                    bContinue = route[0] (data)
+            stats.handled (kind != qJournalEvent, qClock () - t_start)
+            count += 1
+            if bContinue == False:
+                break
+        s = stats.snapshot ()
+        s['records'] = count
+        s['skipped'] = skipped
+        s['virtual_time'] = self.now
+        s['wall_time'] = qClock () - t_begin
+        return s
+
+class qRing (object):
+    # Preallocated ring buffer for high-rate numeric samples (e.g., sensors polled at hundreds of Hz), each a
+    # timestamp followed by a fixed number of values. It is lock-free for exactly one producer thread, which calls
+    # push (), and one consumer - the controller's thread - which calls drain () once per tock to get every new sample
+    # in one go as a NumPy array, without any per-sample allocation. Up to capacity samples can wait to be drained,
+    # whatever the last drain () handed out: the ring has room for twice that, so that the samples handed out stay
+    # valid (untouched by the producer) until the next drain (). If more than capacity samples are waiting, new ones
+    # are dropped and counted as overruns. Requires numpy.
+
+    def __init__ (self, capacity, fields=3, dtype='float64'):
+        if numpy is None:
+            raise ImportError ('qRing requires numpy')
+        self.capacity = capacity
+        self.fields = fields
+        self.size = 2 * capacity # capacity samples waiting, and as many handed out by the last drain ()
+        self.data = numpy.zeros ((self.size, 1 + fields), dtype)
+        self.scratch = numpy.zeros ((capacity, 1 + fields), dtype) # for drains that wrap around the end of data
+        self.head = 0     # number of samples written; only the producer changes this
+        self.drained = 0  # number of samples handed out to the consumer; only the consumer changes this
+        self.overruns = 0 # samples dropped because the ring was full
+        return
+
+    def push (self, t, *values):
+        # producer: returns False (and counts an overrun) if the ring is full
+        head = self.head
+        if head - self.drained >= self.capacity: # the slots before drained are the consumer's until its next drain ()
+            self.overruns += 1
+            return False
+        row = self.data[head % self.size]
+        row[0] = t
+        row[1:1+len (values)] = values
+        self.head = head + 1 # publish the sample only once it has been written
+        return True
+
+    def drain (self):
+        # consumer: returns an array (rows of [t, values...]) of all samples pushed since the last drain (at most
+        # capacity); it is a view of the ring, and is valid only until the next call to drain ()
+        head = self.head
+        count = head - self.drained
+        i = self.drained % self.size
+        if i + count <= self.size:
+            samples = self.data[i:i+count]
+        else:
+            first = self.size - i
+            self.scratch[0:first] = self.data[i:]
+            self.scratch[first:count] = self.data[0:count-first]
+            samples = self.scratch[0:count]
+        self.drained = head
+        return samples
+
+    def counters (self):
+        return { 'capacity': self.capacity, 'waiting': self.head - self.drained, 'overruns': self.overruns }
+
+class qProfiler (object):
+    # Sampling profiler for a running controller: a background thread looks at the stack of every other thread every
+    # interval seconds (sys._current_frames ()) and counts how often each stack is seen. There is no tracing, so the
+    # handlers run at full speed, and it can be started and stopped at any time. collapsed () gives the counts in the
+    # folded format read by flamegraph.pl and speedscope: one 'thread;outermost;...;innermost count' line per stack.
+
+    def __init__ (self, interval=0.005, max_depth=64):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.lock = threading.Lock ()
+        self.counts = {} # stack -> number of samples
+        self.samples = 0
+        self.t_start = None
+        self.t_stop = None
+        self.halt = threading.Event ()
+        self.thread = None
+        return
+
+    def start (self):
+        with self.lock:
+            self.counts = {}
+            self.samples = 0
+        self.t_start = qClock ()
+        self.t_stop = None
+        self.halt.clear ()
+        self.thread = threading.Thread (target=self.run, name='ticktock-profiler')
+        self.thread.daemon = True
+        self.thread.start ()
+        return
+
+    def stop (self):
+        if self.thread is not None:
+            self.halt.set ()
+            if self.thread is not threading.current_thread ():
+                self.thread.join ()
+            self.thread = None
+            self.t_stop = qClock ()
+        return
+
+    def run (self):
+        me = threading.current_thread ().ident
+        while not self.halt.wait (self.interval):
+            names = {}
+            for t in threading.enumerate ():
+                names[t.ident] = t.name
+            frames = sys._current_frames ()
+            with self.lock:
+                for ident in frames:
+                    if ident != me:
+                        stack = qProfiler_stack (frames[ident], names.get (ident, str (ident)), self.max_depth)
+                        self.counts[stack] = self.counts.get (stack, 0) + 1
+                self.samples += 1
+            frames = None # don't keep the other threads' frames alive until the next sample
+        return
+
+    def collapsed (self):
+        with self.lock:
+            lines = [stack + ' ' + str (self.counts[stack]) for stack in self.counts]
+        lines.sort ()
+        return '\n'.join (lines) + '\n' if lines else ''
+
+    def counters (self):
+        t_stop = self.t_stop
+        if t_stop is None:
+            t_stop = qClock ()
+        seconds = 0.0
+        if self.t_start is not None:
+            seconds = t_stop - self.t_start
+        return { 'running': self.thread is not None, 'interval': self.interval, 'samples': self.samples,
+                 'stacks': len (self.counts), 'seconds': seconds }
+
+def qProfiler_stack (frame, thread_name, max_depth):
+    # 'thread;outermost;...;innermost', each frame as 'function (file:line of def)'
+    names = []
+    while frame is not None and len (names) < max_depth:
+        code = frame.f_code
+        names.append (code.co_name + ' (' + os.path.basename (code.co_filename) + ':' + str (code.co_firstlineno) + ')')
+        frame = frame.f_back
+    names.append (thread_name)
+    names.reverse ()
+    return ';'.join ([name.replace (';', ',') for name in names])
+
+class qAdaptiveRate (object):
+    # Adapts the tick interval to activity and load (see qController.adapt ()). While there is input, the controller
+    # ticks every interval seconds; once there has been none for idle_after seconds, it drops to idle_interval, and
+    # the next input brings it straight back. If tock () takes more than overrun_fraction of the period, the interval
+    # backs off by a factor of backoff (up to max_interval), and comes back down once tock () would keep up.
+
+    def __init__ (self, interval, idle_interval, idle_after=2.0, max_interval=None, inputs=None, overrun_fraction=0.8,
+                  backoff=1.5):
+        if max_interval is None:
+            max_interval = max (interval, idle_interval)
+        self.interval = interval
+        self.idle_interval = idle_interval
+        self.idle_after = idle_after
+        self.max_interval = max_interval
+        self.inputs = None # event types that count as input; None for all
+        if inputs is not None:
+            self.inputs = set (inputs)
+        self.overrun_fraction = overrun_fraction
+        self.backoff = backoff
+
+        self.lock = threading.Lock ()
+        self.active_interval = interval # the interval while there is input, after any back-off
+        self.current = interval
+        self.bIdle = False
+        self.t_input = None
+        self.overruns = 0 # tocks that took more than overrun_fraction of the period
+        self.changes = 0  # number of times the interval has changed
+        return
+
+    def input (self, event_type, now):
+        # returns the interval to switch to straight away, if this wakes the controller from idle; otherwise None
+        if self.inputs is not None and event_type not in self.inputs:
+            return None
+        with self.lock:
+            self.t_input = now
+            if not self.bIdle:
+                return None
+            self.bIdle = False
+            self.current = self.active_interval
+            self.changes += 1
+            return self.current
+
+    def tocked (self, now, run_time):
+        # returns the interval for the ticks to come
+        with self.lock:
+            if self.t_input is None:
+                self.t_input = now
+            if run_time > self.overrun_fraction * self.current:
+                self.overruns += 1
+                self.active_interval = min (self.max_interval, self.active_interval * self.backoff)
+            elif run_time < self.overrun_fraction * self.active_interval / self.backoff:
+                self.active_interval = max (self.interval, self.active_interval / self.backoff)
+
+            self.bIdle = (now - self.t_input >= self.idle_after)
+            interval = self.active_interval
+            if self.bIdle:
+                interval = max (self.idle_interval, interval)
+            if interval != self.current:
+                self.current = interval
+                self.changes += 1
+            return interval
+
+    def counters (self):
+        return { 'interval': self.current, 'idle': self.bIdle, 'overruns': self.overruns, 'changes': self.changes }
+
 class qController (object):
-    def __init__ (self, default_event_handler, timer_interval):
+    def __init__ (self, default_event_handler, timer_interval, overrun=qOverrunSkip, clock=None):
+        # clock: called for the time in seconds (default qClock); a qVirtualClock runs the controller on virtual time
         self.controller = default_event_handler
         self.timer_interval = timer_interval
-        self.TickTock = PriorityQueue ()
+        if clock is None:
+            clock = qClock
+        self.clock = clock
+        self.bVirtual = isinstance (clock, qVirtualClock)
+        self.TickTock = qQueue ()
+        self.TickTock.clock = clock
+        self.ticker = qTimer (self, 'tick', timer_interval, None, overrun)
+        self.timers = {} # name -> qTimer, for timers added with add_timer ()
+        if self.bVirtual:
+            self.scheduler = qVirtualScheduler (clock)
+        else:
+            self.scheduler = qScheduler (clock)
+        self.scheduler.add (self.ticker)
+        self.coalescer = qCoalescer ()
+        self.TickTock.on_drop = self.coalescer.discard
+        self.stats = qStats (timer_interval)
+        self.priority_class (qPriorityHigh,   'high')
+        self.priority_class (qPriorityNormal, 'normal')
+        # a tick that has waited a whole period ranks with normal events, and after half a period it goes next
+        # regardless - otherwise, under steady traffic, qOverrunSkip would skip every other deadline
+        self.priority_class (qPriorityLow,    'low', 1.0 / timer_interval, timer_interval / 2.0)
+        self.pool = None
+        self.recorder = None
+        self.channels = {} # name -> qRing
+        self.thread_settings = {} # 'dispatch' / 'workers' -> qThreadSettings; see pin ()
+        self.profiler = None
+        self.adaptive = None # qAdaptiveRate; see adapt ()
+        self.own_threads = set () # idents of the threads that take from the queue: run ()'s and the pool's
+        self.handlers = {} # event_type -> (callback, bBatch), for events for the default handler; see on ()
         return
-        
+
+    def put (self, priority, q, bEvent=True):
+        # a handler queueing an event from one of the controller's own threads mustn't wait for room, as only they
+        # make any (the dispatch thread in submit () waits for the workers, so they mustn't wait either)
+        bMayBlock = (threading.current_thread ().ident not in self.own_threads)
+        bQueued = self.TickTock.put (priority, q, bEvent, bMayBlock)
+        self.stats.queued (len (self.TickTock))
+        return bQueued
+
     def stop (self):
-        q = qData ('stop')
-        self.TickTock.put ((qPriorityHigh, q))
+        self.put (qPriorityHigh, qData ('stop', None, None, self.clock ()), False)
+        if self.pool is not None:
+            self.pool.interrupt ()
         return
 
-    def tick (self):
-        time.sleep (self.timer_interval)
-        q = qData ('tick')
-        self.TickTock.put ((qPriorityLow, q))
+    def coalesce (self, event_type, enable=True):
+        # a newer event of this type replaces one that is still waiting in the queue (e.g., joystick positions)
+        self.coalescer.coalesce (event_type, enable)
+        return
 
-    def event (self, event_type, data=None, handler=None):
-        q = qData (event_type, data, handler)
+    def activity (self, event_type, now):
+        interval = self.adaptive.input (event_type, now)
+        if interval is not None: # back from idle: tick now, and then at the faster rate
+            self.ticker.retime (interval)
+            self.scheduler.reschedule (self.ticker, now)
+        return
+
+    def tick (self, timer, t_due=None):
+        q = qData ('tick', timer, None, self.clock ())
+        q.t_due = t_due
+        self.put (qPriorityLow, q, False)
+        return
+
+    def event (self, event_type, data=None, handler=None, ttl=None, deadline=None, priority=qPriorityNormal):
+        # returns False if the event was dropped or refused because the queue is full
+        # if ttl (seconds from now) or deadline (in the controller's clock () time) is given, the event will be dropped if it can't be
+        # dispatched in time; otherwise, it is dispatched in order of deadline amongst events of the same priority
+        # priority may be any number (lower is more urgent); see priority_class () for aging and maximum delays
+        q = qData (event_type, data, handler, self.clock ())
+        if self.adaptive is not None:
+            self.activity (event_type, q.t_queued)
         if handler is None:
             q.event_handler = self.controller
-        self.TickTock.put ((qPriorityNormal, q))
+        if ttl is not None:
+            q.deadline = q.t_queued + ttl
+        if deadline is not None:
+            q.deadline = deadline
+        if self.coalescer.fold (q):
+            return True
+        return self.put (priority, q)
 
-    def run (self):
-        t = threading.Thread (target=qController_tick, args=(self,)) # add a delayed event to the queue
-        t.start ()
+    def on (self, event_type, callback=None, bBatch=False):
+        # events of this type for the default handler go to callback (value) instead of handler.event (name, value);
+        # with bBatch, every event of the type waiting in the queue is taken at once and passed as callback (values)
+        # callback=None to send them back to handler.event (); as ever, if callback returns False, the controller stops
+        if callback is None:
+            self.handlers.pop (event_type, None)
+        else:
+            self.handlers[event_type] = (callback, bBatch)
+        return
 
-        while True:
-            p, q = self.TickTock.get ()
+    def batch (self, event_type, enable=True):
+        # events of this type for the default handler are passed, all those waiting at once, to the handler's
+        # event_batch (name, values) instead of one by one to event (name, value)
+        if enable:
+            event_batch = self.controller.event_batch
+            self.on (event_type, lambda values: event_batch (event_type, values), True)
+        else:
+            self.on (event_type)
+        return
 
-            if q.event_type == 'stop':
-                break
+    def limit (self, capacity, overflow=qOverflowDropOldest, timeout=None):
+        # bound the number of events waiting in the queue (0 for no limit); see qOverflow* for the policies
+        self.TickTock.limit (capacity, overflow, timeout)
+        return
+
+    def priority_class (self, priority, name=None, aging=0.0, max_delay=None):
+        # defines (or redefines) a priority class: the longer an item waits, the more urgent it becomes, by aging
+        # priority levels per second; and after max_delay seconds, it goes next (see qPriorityClass)
+        self.TickTock.priority_class (priority, name, aging, max_delay)
+        if name is not None:
+            self.stats.priority_names[priority] = name
+        return
+
+    def tick_interval (self, interval, bNow=False):
+        # changes the tick period, from the tick after next; or with bNow, the next tick is due straight away
+        self.ticker.retime (interval)
+        if bNow:
+            self.scheduler.reschedule (self.ticker, self.clock ())
+        return
+
+    def adapt (self, idle_interval, idle_after=2.0, max_interval=None, inputs=None, overrun_fraction=0.8, backoff=1.5):
+        # adapt the tick rate to activity and load (see qAdaptiveRate): tick every timer_interval while events of the
+        # types in inputs (None for all) keep arriving, every idle_interval otherwise, and back off (to at most
+        # max_interval) if tock () overruns; idle_interval=None to tick at the fixed rate again
+        if idle_interval is None:
+            self.adaptive = None
+            self.tick_interval (self.timer_interval)
+        else:
+            self.adaptive = qAdaptiveRate (self.timer_interval, idle_interval, idle_after, max_interval, inputs,
+                                           overrun_fraction, backoff)
+        return
+
+    def tick_max_delay (self, seconds):
+        # the longest that a tick may wait behind other events before it is dispatched regardless (by default, half
+        # the tick interval; None for no limit); see snapshot ()['queue']['classes']['low'] for how long ticks have
+        # actually waited
+        with self.TickTock.cv: # priority_class () would reset the class's aging
+            self.TickTock.classes[qPriorityLow].max_delay = seconds
+        return
+
+    def slack (self, seconds):
+        # the implicit deadline of events queued without one, in seconds after they were queued
+        self.TickTock.slack = seconds
+        return
+
+    def load (self):
+        # how full the queue is, from 0 to 1; front ends can use this to shed load before the controller falls behind
+        return self.TickTock.load ()
+
+    def channel (self, name, capacity=1024, fields=3):
+        # returns the sample ring buffer called name (see qRing), creating it if necessary; the sampling thread
+        # push ()es samples into it, and tock () can drain () them all at once
+        ring = self.channels.get (name)
+        if ring is None:
+            ring = qRing (capacity, fields)
+            self.channels[name] = ring
+        return ring
+
+    def pin (self, thread, cpus=None, policy=None, priority=None):
+        # runs the controller's 'dispatch' thread (whichever calls run ()), its timer 'scheduler' thread, or the
+        # 'workers' of its dispatch pool (see parallel ()) on the given CPUs, e.g., [3], and/or with the scheduling
+        # policy qSchedFIFO or qSchedRR at the given priority; taking effect when run () is next called, as far as the
+        # OS permits (see qThreadSettings); snapshot ()['threads'] reports what actually applied
+        if thread not in ('dispatch', 'scheduler', 'workers'):
+            raise ValueError ('unknown controller thread: ' + str (thread))
+        settings = qThreadSettings (thread, cpus, policy, priority)
+        if thread == 'scheduler':
+            self.scheduler.settings = settings
+        else:
+            self.thread_settings[thread] = settings
+        return
+
+    def thread_setup (self, thread):
+        # called on each of the controller's threads as it starts
+        self.own_threads.add (threading.current_thread ().ident)
+        settings = self.thread_settings.get (thread)
+        if settings is not None:
+            settings.apply ()
+        return
+
+    def thread_exit (self):
+        # called on each of the controller's threads as it finishes, as its ident may be reused by another thread
+        self.own_threads.discard (threading.current_thread ().ident)
+        return
+
+    def profile (self, action=None, interval=0.005):
+        # 'start' sampling the whole process's stacks (see qProfiler), starting afresh; 'stop' sampling; otherwise
+        # neither; returns the stack counts so far (if any) in flame graph folded format
+        if action == 'start':
+            if self.profiler is not None:
+                self.profiler.stop ()
+            self.profiler = qProfiler (interval)
+            self.profiler.start ()
+        elif action == 'stop' and self.profiler is not None:
+            self.profiler.stop ()
+        if self.profiler is None:
+            return ''
+        return self.profiler.collapsed ()
+
+    def journal (self, path, flush_interval=0.5):
+        # record everything dispatched to the handler in a binary journal (see qJournal); path=None to stop recording
+        if self.recorder is not None:
+            self.recorder.close ()
+            self.recorder = None
+        if path is not None:
+            self.recorder = qJournal (path, flush_interval, clock=self.clock)
+        return
+
+    def now (self):
+        # the time according to the controller's clock, which handlers should use instead of the wall clock so as to
+        # work on virtual time as well
+        return self.clock ()
+
+    def parallel (self, workers, key=None):
+        # dispatch events on a pool of worker threads (see qDispatchPool); call before run(); workers=0 to turn off
+        if workers > 0 and self.bVirtual:
+            raise ValueError ('virtual time needs the handlers on the controller\'s own thread')
+        if workers > 0:
+            self.pool = qDispatchPool (self, workers, key)
+        else:
+            self.pool = None
+        return
+
+    def add_timer (self, name, interval, callback, overrun=qOverrunSkip):
+        # callback (data) is called every interval seconds, on the controller's thread, just like tock (data);
+        # if it returns False, the controller stops
+        self.remove_timer (name)
+        timer = qTimer (self, name, interval, callback, overrun)
+        self.timers[name] = timer
+        self.scheduler.add (timer)
+        return timer
+
+    def remove_timer (self, name):
+        timer = self.timers.pop (name, None)
+        if timer is not None:
+            self.scheduler.remove (timer)
+        return
+
+    def snapshot (self, reset=False):
+        # a cheap summary of queue latency, handler run time, tick jitter, queue depth and dropped/folded events
+        s = self.stats.snapshot ()
+        s['ticks'] = self.ticker.counters ()
+        if self.adaptive is not None:
+            s['rate'] = self.adaptive.counters ()
+        timers = {}
+        for name in list (self.timers):
+            timers[name] = self.timers[name].counters ()
+        s['timers'] = timers
+        s['folded'] = self.coalescer.total_folded ()
+        s['queue'] = self.TickTock.counters ()
+        channels = {}
+        for name in list (self.channels):
+            channels[name] = self.channels[name].counters ()
+        s['channels'] = channels
+        threads = {}
+        for settings in list (self.thread_settings.values ()) + [self.scheduler.settings]:
+            if settings is not None:
+                threads[settings.name] = settings.effective
+        s['threads'] = threads
+        if self.profiler is not None:
+            s['profiler'] = self.profiler.counters ()
+        if reset:
+            self.stats.reset ()
+        return s
+
+    def dispatch (self, priority, q):
+        # passes the event on to its handler; returns False if the handler wants the controller to stop
+        t_start = qClock () # handler run times are always real
+        now = t_start
+        if self.clock is not qClock:
+            now = self.clock ()
+        self.stats.dispatched (priority, now - q.t_queued)
 
-            event_handler = q.event_handler
+        event_handler = q.event_handler
+        bContinue = True
 
-            if q.event_type == 'tick':
-                if event_handler is None: # assume this is our local timer
-                    if self.controller.tock (q.event_data) == False:
-                        break
-                    t = threading.Thread (target=qController_tick, args=(self,)) # add a new delayed event to the queue
-                    t.start ()
-                else: # another ticker wants a tock...
-                    if event_handler.tock (q.event_data) == False:
-                        break
+        bTock = (q.event_type == 'tick')
+        if bTock:
+            if event_handler is None: # one of our own timers
+                timer = q.event_data
+                if q.t_due is not None and now - q.t_due > timer.late_tolerance:
+                    timer.late += 1 # whether the scheduler woke late or the tick waited behind other work
+                if timer is self.ticker:
+                    self.stats.ticked (now, timer.interval)
+                    data = timer.take (q)
+                    if self.recorder is not None:
+                        self.recorder.record (now, priority, qJournalTick, timer.name, data)
+                    bContinue = self.controller.tock (data)
+                    if self.adaptive is not None:
+                        interval = self.adaptive.tocked (now, qClock () - t_start)
+                        if interval != timer.interval:
+                            timer.retime (interval)
+                elif timer.bActive:
+                    data = timer.take (q)
+                    if self.recorder is not None:
+                        self.recorder.record (now, priority, qJournalTimer, timer.name, data)
+                    bContinue = timer.callback (data)
+            else: # another ticker wants a tock...
+                bContinue = event_handler.tock (q.event_data)
 
-            elif event_handler is not None:
-                if event_handler.event (q.event_type, q.event_data) == False:
+        elif event_handler is not None:
+            data = self.coalescer.take (q)
+            route = None
+            if event_handler is self.controller:
+                if self.recorder is not None:
+                    self.recorder.record (now, priority, qJournalEvent, q.event_type, data)
+                route = self.handlers.get (q.event_type)
+            if route is None:
+                bContinue = event_handler.event (q.event_type, data)
+            else:
+                callback, bBatch = route
+                if bBatch:
+                    bContinue = callback (self.gather (q, data, now))
+                else:
+                    bContinue = callback (data)
+
+        self.stats.handled (bTock, qClock () - t_start)
+        return bContinue != False
+
+    def gather (self, q, data, now):
+        # for batched dispatch: data, followed by the values of all the other events like q still in the queue
+        values = [data]
+        event_type = q.event_type
+        event_handler = q.event_handler
+        for priority, w in self.TickTock.take_matching (lambda w: w.event_type == event_type and w.event_handler is event_handler):
+            self.stats.dispatched (priority, now - w.t_queued)
+            data = self.coalescer.take (w)
+            if self.recorder is not None:
+                self.recorder.record (now, priority, qJournalEvent, event_type, data)
+            values.append (data)
+        return values
+
+    def next_virtual (self):
+        # on virtual time, whenever the queue is empty, jump straight to the next timer deadline
+        item = self.TickTock.get_nowait ()
+        while item is None and self.scheduler.advance ():
+            item = self.TickTock.get_nowait ()
+        if item is None: # no timers, so wait for another thread to add something
+            item = self.TickTock.get ()
+        return item
+
+    def run (self):
+        self.TickTock.open ()
+        self.thread_setup ('dispatch')
+        if self.pool is not None:
+            self.pool.start ()
+        self.scheduler.start ()
+
+        try:
+            while True:
+                if self.bVirtual:
+                    p, q = self.next_virtual ()
+                else:
+                    p, q = self.TickTock.get ()
+
+                if q.event_type == 'stop':
                     break
 
-            self.TickTock.task_done ()
+                if self.pool is not None:
+                    self.pool.submit (p, q)
+                elif not self.dispatch (p, q):
+                    break
+        finally: # even if a handler raises
+            self.TickTock.close ()
+            self.thread_exit ()
+            self.scheduler.stop ()
+            if self.pool is not None:
+                self.pool.stop ()
+            self.journal (None)
         return
@@ -0,0 +1,229 @@
+# asyncio version of ticktock.qController (Python 3 only)
+#
+# The event handler contract is the same: handler.tock (data) is called periodically, handler.event (name, value)
+# for each event, and either returning False stops the controller. Everything - the controller, the tick scheduler
+# and (optionally) the MQTT client - runs on one asyncio event loop, so an MQTT message reaches handler.event()
+# without being passed between threads.
+
+import asyncio
+import threading
+
+import ticktock
+
+from ticktock import qOverrunSkip
+
+class qAsyncScheduler (object):
+    # Serves the controller's timers from the event loop (whose own timer heap does the ordering)
+
+    def __init__ (self):
+        self.timers = []
+        self.handles = {}
+        self.loop = None
+        self.loop_thread = None
+        self.settings = None # there's no thread of its own to apply qThreadSettings to
+        return
+
+    def add (self, timer):
+        if timer not in self.timers:
+            self.timers.append (timer)
+        if self.loop is not None:
+            self.schedule (timer, self.loop.time ())
+        return
+
+    def remove (self, timer):
+        timer.bActive = False
+        if timer in self.timers:
+            self.timers.remove (timer)
+        handle = self.handles.pop (timer, None)
+        if handle is not None:
+            handle.cancel ()
+        return
+
+    def reschedule (self, timer, deadline):
+        if self.loop is None:
+            return
+        if threading.get_ident () != self.loop_thread: # e.g., an event from paho's network thread
+            self.loop.call_soon_threadsafe (self.reschedule, timer, deadline)
+            return
+        handle = self.handles.get (timer)
+        if handle is not None:
+            handle.cancel ()
+        timer.deadline = deadline
+        self.handles[timer] = self.loop.call_at (deadline, self.fire, timer)
+        return
+
+    def schedule (self, timer, now):
+        timer.reset (now)
+        self.handles[timer] = self.loop.call_at (timer.deadline, self.fire, timer)
+        return
+
+    def fire (self, timer):
+        count = timer.advance (self.loop.time ())
+        self.handles[timer] = self.loop.call_at (timer.deadline, self.fire, timer)
+        timer.deliver (count)
+        return
+
+    def start (self):
+        self.loop = asyncio.get_event_loop ()
+        self.loop_thread = threading.get_ident ()
+        now = self.loop.time ()
+        for timer in self.timers:
+            self.schedule (timer, now)
+        return
+
+    def stop (self):
+        for timer in self.handles:
+            self.handles[timer].cancel ()
+        self.handles = {}
+        self.loop = None
+        return
+
+class AsyncQController (ticktock.qController):
+    def __init__ (self, event_handler, timer_interval, overrun=qOverrunSkip):
+        ticktock.qController.__init__ (self, event_handler, timer_interval, overrun)
+        self.wakeup = None # created by run(), on the event loop
+        self.scheduler = qAsyncScheduler ()
+        self.scheduler.add (self.ticker)
+        self.loop = None
+        self.loop_thread = None
+        self.bListening = False
+        return
+
+    def parallel (self, workers, key=None):
+        # handlers are always dispatched on the event loop; use ticktock.qController for a pool of worker threads
+        if workers > 0:
+            raise ValueError ('AsyncQController does not support parallel dispatch')
+        return
+
+    def put (self, priority, q, bEvent=True):
+        if not self.bListening:
+            return False
+        bLoop = (threading.get_ident () == self.loop_thread)
+        bQueued = self.TickTock.put (priority, q, bEvent, not bLoop) # the event loop itself must never wait
+        self.stats.queued (len (self.TickTock))
+        if bQueued and not self.wakeup.is_set ():
+            if bLoop:
+                self.wakeup.set ()
+            else: # from another thread, e.g., paho's own network thread
+                self.loop.call_soon_threadsafe (self.wakeup.set)
+        return bQueued
+
+    async def run (self):
+        if self.bListening:
+            return False
+
+        self.loop = asyncio.get_event_loop ()
+        self.loop_thread = threading.get_ident ()
+        self.wakeup = asyncio.Event ()
+        self.TickTock.clear ()
+        self.coalescer.clear ()
+        self.TickTock.open ()
+
+        self.bListening = True
+
+        self.thread_setup ('dispatch') # the event loop's thread; the timers are served by the loop itself
+        self.scheduler.start ()
+
+        try:
+            while True:
+                item = self.TickTock.get_nowait ()
+                if item is None:
+                    self.wakeup.clear ()
+                    item = self.TickTock.get_nowait () # in case something arrived just before the clear ()
+                    if item is None:
+                        await self.wakeup.wait ()
+                        continue
+                p, q = item
+
+                if q.event_type == 'stop':
+                    break
+
+                if not self.dispatch (p, q):
+                    break
+        finally:
+            self.bListening = False
+            self.TickTock.close () # producers waiting for room in another thread give up
+            self.thread_exit ()
+            self.scheduler.stop ()
+            self.journal (None)
+        return True
+
+class qAsyncMQTT (object):
+    # Drives a paho.mqtt client (1.5 or later) from the event loop instead of client.loop_start(), so that
+    # on_message() is called on the same thread as the controller. Like loop_start(), it reconnects if the connection
+    # is lost (e.g., the broker restarts, or the WiFi drops), waiting reconnect_min seconds at first, doubling up to
+    # reconnect_max while it keeps failing; the client's on_connect is called again each time, to resubscribe.
+
+    def __init__ (self, client, loop=None, reconnect_min=1.0, reconnect_max=120.0):
+        if loop is None:
+            loop = asyncio.get_event_loop ()
+        self.client = client
+        self.loop = loop
+        self.reconnect_min = reconnect_min
+        self.reconnect_max = reconnect_max
+        self.misc = None
+        self.bRunning = True # until stop (); after that, a lost connection stays lost
+        self.reconnects = 0
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+        return
+
+    def on_socket_open (self, client, userdata, sock):
+        self.loop.add_reader (sock, client.loop_read)
+        if self.misc is None and self.bRunning:
+            self.misc = self.loop.create_task (self.misc_loop ())
+        return
+
+    def on_socket_close (self, client, userdata, sock):
+        self.loop.remove_reader (sock) # misc_loop () carries on, to reconnect
+        return
+
+    def stop (self):
+        self.bRunning = False
+        if self.misc is not None:
+            self.misc.cancel ()
+        self.misc = None
+        return
+
+    def on_socket_register_write (self, client, userdata, sock):
+        self.loop.add_writer (sock, client.loop_write)
+        return
+
+    def on_socket_unregister_write (self, client, userdata, sock):
+        self.loop.remove_writer (sock)
+        return
+
+    async def misc_loop (self):
+        # keepalive pings and retries while connected - loop_misc() returns 0 (MQTT_ERR_SUCCESS) - and reconnection
+        # while not
+        delay = self.reconnect_min
+        try:
+            while self.bRunning:
+                if self.client.loop_misc () == 0:
+                    delay = self.reconnect_min
+                    await asyncio.sleep (1)
+                    continue
+                await asyncio.sleep (delay)
+                delay = min (2 * delay, self.reconnect_max)
+                if not self.bRunning:
+                    break
+                try:
+                    self.client.reconnect () # a blocking connect, as in loop_start()'s own thread
+                    self.reconnects += 1
+                except (OSError, ValueError): # the broker isn't back yet; try again later
+                    pass
+        except asyncio.CancelledError:
+            pass
+        return
+
+async def run_with_mqtt (queue_controller, client, host, port, keepalive=60):
+    driver = qAsyncMQTT (client)
+    client.connect (host, port, keepalive)
+    try:
+        await queue_controller.run ()
+    finally:
+        driver.stop ()
+        client.disconnect ()
+    return
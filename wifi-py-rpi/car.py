@@ -1,6 +1,12 @@
+import json
+
 import paho.mqtt.client as mqtt
 
+import fleet
 import ticktock
+import xycodec
+import outbound
+import telemetry
 
 # MQTT constants
 
@@ -9,40 +15,162 @@ mqtt_server_host = "192.168.99.234"
 # default port for MQTT
 mqtt_server_port = 1883
 
+# run the controller and the MQTT client together on one asyncio event loop (Python 3.7+, paho-mqtt 1.5+)
+use_asyncio = False
+
+if use_asyncio:
+    import asyncio
+    import asyncticktock
+
 addr_sys_exit = "/wifi-py-rpi-car-controller/system/exit"
 addr_car_xy   = "/wifi-py-rpi-car-controller/car/XY"
 addr_dash_xy  = "/wifi-py-rpi-car-controller/dash/XY"
+addr_car_stats = "/wifi-py-rpi-car-controller/car/stats"
+addr_car_telemetry = "/wifi-py-rpi-car-controller/car/telemetry"          # JSON: the fields that have changed
+addr_car_snapshot  = "/wifi-py-rpi-car-controller/car/telemetry/snapshot" # JSON: all the fields; retained
+addr_car_encoding = "/wifi-py-rpi-car-controller/car/encoding" # the XY encodings (see xycodec) that each side can decode
+addr_dash_encoding = "/wifi-py-rpi-car-controller/dash/encoding"
+addr_sys_profile = "/wifi-py-rpi-car-controller/system/profile" # payload: start, stop (publishes the result) or dump
+addr_car_profile = "/wifi-py-rpi-car-controller/car/profile"    # stack counts in flame graph folded format
+
+# in a fleet (several cars sharing one controller; see fleet.py), this car's name: its car/... and dash/... topics are
+# then under /wifi-py-rpi-car-controller/fleet/<car_name>/ and its MQTT client ID is car-<car_name>; None for one car
+car_name = None
+
+if car_name is not None:
+    addr_car_xy        = fleet.fleet_namespace (addr_car_xy,        car_name)
+    addr_dash_xy       = fleet.fleet_namespace (addr_dash_xy,       car_name)
+    addr_car_stats     = fleet.fleet_namespace (addr_car_stats,     car_name)
+    addr_car_telemetry = fleet.fleet_namespace (addr_car_telemetry, car_name)
+    addr_car_snapshot  = fleet.fleet_namespace (addr_car_snapshot,  car_name)
+    addr_car_encoding  = fleet.fleet_namespace (addr_car_encoding,  car_name)
+    addr_dash_encoding = fleet.fleet_namespace (addr_dash_encoding, car_name)
+    addr_car_profile   = fleet.fleet_namespace (addr_car_profile,   car_name)
+
+# encoding of the positions published on addr_car_xy: 'text', which every dashboard can read, xycodec.xy_encoding_binary,
+# or 'auto' to switch to binary once a dashboard announces that it can decode it - only when every dashboard that may
+# connect is new enough to, as one announcement switches the topic for all of them
+xy_encoding = 'text'
+
+# telemetry (including addr_car_xy) is only published when something changes; the position by more than this
+position_deadband = 0.005
+
+# at most this many messages wait to be handed to the MQTT client (a newer one for the same topic replaces an older)
+outbound_capacity = 64
+
+# commands (e.g., joystick positions) that can't be handled within this many seconds are dropped as stale
+command_ttl = 0.3
+
+# tock() is called at most this many seconds after it is due, however many commands are waiting; keep it well under
+# the tick interval (0.1), so that busy spells don't cost whole ticks
+tick_max_delay = 0.02
+
+# record everything the controller dispatches in this file, for replay with ticktock.qReplay; None to disable
+journal_path = None
+
+# publish the controller's queue/timing statistics (as JSON) every this many seconds; 0 to disable
+stats_interval = 5
+
+# run the controller's threads on these CPUs (e.g., [3]) and/or with a real-time scheduling policy (ticktock.qSchedFIFO
+# or ticktock.qSchedRR, which usually need root); None to leave them to the OS - what actually applied is printed
+controller_cpus = None
+controller_policy = None
+
+# adaptive tick rate (off by default): once no joystick input has arrived for idle_after seconds, tick only every
+# idle_interval seconds (e.g., 1.0) - so tock(), and whatever it does to check the sensors or adjust the motors, runs
+# that much less often until the next input, which brings back the full rate at once; the rate also backs off if
+# tock() can't keep up. Only for a car that can safely be left alone while idle. None for a fixed rate (the rate in
+# use is reported as "rate" in the stats)
+idle_interval = None
+idle_after = 5
 
 # It is possible to create a separate thread dedicated to checking the sensors, which might send events when necessary.
+# Or, to keep sensor polling away from the GIL altogether, run it in a process of its own with sensorticktock.qSampler,
+# and read the latest frame in tock().
 
 class car_controller (object):
     def __init__ (self):
-        self.queue_controller = ticktock.qController (self, 0.1) # 0.1 = tenth of a second
+        if use_asyncio:
+            self.queue_controller = asyncticktock.AsyncQController (self, 0.1) # 0.1 = tenth of a second
+        else:
+            self.queue_controller = ticktock.qController (self, 0.1) # 0.1 = tenth of a second
+        self.queue_controller.coalesce (addr_dash_xy) # only the latest joystick position matters
+        self.queue_controller.limit (64) # if commands arrive faster than they can be handled, drop the oldest
+        self.queue_controller.tick_max_delay (tick_max_delay)
+        if controller_cpus is not None or controller_policy is not None:
+            self.queue_controller.pin ('dispatch', controller_cpus, controller_policy)
+            self.queue_controller.pin ('scheduler', controller_cpus, controller_policy)
+        if idle_interval is not None:
+            self.queue_controller.adapt (idle_interval, idle_after, inputs=[addr_dash_xy])
+        if journal_path is not None:
+            self.queue_controller.journal (journal_path)
+        if stats_interval > 0:
+            self.queue_controller.add_timer ('stats', stats_interval, self.publish_stats)
         # Initialise variables here:
-        self.latest_position = "0 0"
+        self.latest_position = (0.0, 0.0)
+        self.xy = xycodec.xy_sender ()
+        if xy_encoding == xycodec.xy_encoding_binary:
+            self.xy.encoding = xy_encoding
+        self.outbound = outbound.publish_pipeline (outbound_capacity) # started once there's an MQTT client
+        self.telemetry = telemetry.telemetry_publisher (self.publish, addr_car_telemetry, addr_car_snapshot)
+        self.telemetry.field ('position', position_deadband)
+        self.telemetry.field ('interval') # the tick interval, which adapts to activity
         # ----
         return
 
     def tock (self, data):
         # This function is called periodically. Here is where you check the sensors or adjust the motor settings, etc.
         # Don't try to do too much - there may be more important things being added to the queue... 
-        print ('tock: latest position = ' + self.latest_position)
-        client.publish (addr_car_xy, self.latest_position)
+        print ('tock: latest position = ' + xycodec.xy_text (*self.latest_position))
+        self.telemetry.set ('position', self.latest_position)
+        self.telemetry.set ('interval', self.queue_controller.ticker.interval)
+        changed = self.telemetry.flush () # all the fields that have changed, in one message
+        if 'position' in changed: # retained, so that a dashboard gets the position as soon as it subscribes
+            self.publish (addr_car_xy, self.xy.encode (*self.latest_position), True)
         # ----
         return True
 
     def event (self, name, value):
         # This is probably a command relayed from the human controller, but is certainly more urgent than tock()
-        print ('event: name=' + name + ', value=' + value)
         if name == addr_dash_xy:
-            self.latest_position = value
+            try:
+                x, y, sequence, t = xycodec.xy_decode (value)
+            except ValueError:
+                return True
+            print ('event: name=' + name + ', value=' + xycodec.xy_text (x, y))
+            self.latest_position = (x, y)
         # ----
         return True
 
 # ======== DO NOT TOUCH ANYTHING BELOW THIS LINE ========
 
+    def publish (self, topic, payload, retain=False, bSupersede=True):
+        self.outbound.publish (topic, payload, retain, bSupersede) # never waits for the client
+        return
+
+    def publish_stats (self, data):
+        self.publish (addr_car_stats, json.dumps (self.stats (True)))
+        return True
+
+    def stats (self, reset=False):
+        s = self.queue_controller.snapshot (reset)
+        s['telemetry'] = self.telemetry.counters ()
+        s['outbound'] = self.outbound.counters (reset)
+        return s
+
     def command (self, name, value):
-        self.queue_controller.event (name, value)
+        self.queue_controller.event (name, value, command_ttl)
+        return
+
+    def negotiate (self, announcement):
+        if xy_encoding == 'auto' and xycodec.xy_accepts_binary (announcement):
+            self.xy.encoding = xycodec.xy_encoding_binary
+        return
+
+    def profile (self, action):
+        stacks = self.queue_controller.profile (action)
+        if action != 'start':
+            client.publish (addr_car_profile, stacks)
         return
 
     def stop (self):
@@ -55,27 +183,46 @@ class car_controller (object):
 
 # MQTT callbacks
 
-def on_connect (client, car, rc):
+def on_connect (client, car, *args): # (flags, rc) with paho-mqtt 1.0 and later, (rc) before
+    rc = args[-1]
     print ("MQTT: on_connect: response code = " + str (rc))
     client.subscribe (addr_sys_exit)
     client.subscribe (addr_dash_xy)
+    client.subscribe (addr_sys_profile)
+    client.subscribe (addr_dash_encoding)
+    client.publish (addr_car_encoding, xycodec.xy_encodings, retain=True)
 
 def on_message (client, car, msg):
-    print ("topic [" + msg.topic + "] -> data [" + msg.payload + "]")
+    text = msg.payload
+    if not isinstance (text, str): # bytes, in Python 3
+        text = text.decode ('ascii', 'replace')
+    print ("topic [" + msg.topic + "] -> data [" + text + "]")
     if msg.topic == addr_sys_exit:
-        if msg.payload == "car":
+        if text == "car" or text == fleet.fleet_client_id (car_name): # every car, or just this one
             car.stop ()
+    elif msg.topic == addr_dash_encoding:
+        car.negotiate (msg.payload)
+    elif msg.topic == addr_sys_profile:
+        car.profile (text)
     else:
         car.command (msg.topic, msg.payload)
 
 if __name__ == "__main__":
     car = car_controller ()
 
-    client = mqtt.Client (client_id='car', clean_session=True, userdata=car, protocol=mqtt.MQTTv31)
+    client = mqtt.Client (client_id=fleet.fleet_client_id (car_name), clean_session=True, userdata=car, protocol=mqtt.MQTTv31)
     client.on_connect = on_connect
     client.on_message = on_message
 
-    client.connect (mqtt_server_host, mqtt_server_port, 60) # ping once a minute
-    client.loop_start ()
+    if use_asyncio:
+        loop = asyncio.new_event_loop ()
+        asyncio.set_event_loop (loop)
+        car.outbound.start (client, loop) # hand messages to the client on the event loop, as it's not thread-safe there
+        loop.run_until_complete (asyncticktock.run_with_mqtt (car.queue_controller, client, mqtt_server_host, mqtt_server_port, 60))
+        loop.close ()
+    else:
+        client.connect (mqtt_server_host, mqtt_server_port, 60) # ping once a minute
+        car.outbound.start (client) # drives the client's network loop (instead of client.loop_start ())
 
-    car.run ()
+        car.run ()
+        car.outbound.stop ()
@@ -1,24 +1,83 @@
 import paho.mqtt.client as mqtt
+import os
 import sys
+import json
+import time
+import threading
+
+import fleet
+import xycodec
 
 mqtt_server_host = "192.168.99.234"
 mqtt_server_port = 1883
 
+# run the MQTT broker in this process (see mqttbroker.py; Python 3) rather than using a separate one such as mosquitto;
+# it also serves the dashboard (../mqtt) and MQTT over websockets for it on embed_websocket_port
+embed_broker = False
+embed_websocket_port = 9001
+embed_http_dir = os.path.join (os.path.dirname (os.path.abspath (__file__)), '..', 'mqtt')
+
+# supervise a fleet of cars (see fleet.py and car_name in car.py) instead of one: every car's position and telemetry
+# is gathered into a combined view, which is printed and published (retained) on fleet.addr_fleet_view this often
+fleet_mode = False
+fleet_view_interval = 1.0
+
 addr_sys_exit = "/wifi-py-rpi-car-controller/system/exit"
+addr_car_xy   = "/wifi-py-rpi-car-controller/car/XY"
 
-def on_connect (client, userdata, rc):
+aggregator = fleet.fleet_aggregator ()
+exit_requested = threading.Event ()
+
+def on_connect (client, userdata, *args): # (flags, rc) with paho-mqtt 1.0 and later, (rc) before
+    rc = args[-1]
     print ("Connected, response code = " + str (rc))
     client.subscribe (addr_sys_exit)
+    if fleet_mode:
+        client.subscribe (fleet.fleet_topic (fleet.fleet_any, 'car/XY'))
+        client.subscribe (fleet.fleet_topic (fleet.fleet_any, 'car/telemetry'))
+        client.subscribe (fleet.fleet_topic (fleet.fleet_any, 'car/telemetry/snapshot'))
+    else:
+        client.subscribe (addr_car_xy)
 
 def on_message (client, userdata, msg):
-    print ("topic [" + msg.topic + "] -> data [" + msg.payload + "]")
+    if fleet_mode and aggregator.message (msg.topic, msg.payload):
+        return
+    if msg.topic == addr_car_xy: # text or binary; see xycodec
+        try:
+            x, y, sequence, t = xycodec.xy_decode (msg.payload)
+        except ValueError:
+            return
+        if t is None:
+            print ("car position: " + xycodec.xy_text (x, y))
+        else:
+            print ("car position: " + xycodec.xy_text (x, y) + " #" + str (sequence) + ", %.1f ms ago" % (1000 * (time.time () - t)))
+        return
+    text = msg.payload
+    if not isinstance (text, str): # bytes, in Python 3
+        text = text.decode ('ascii', 'replace')
+    print ("topic [" + msg.topic + "] -> data [" + text + "]")
     if msg.topic == addr_sys_exit:
-        if msg.payload == "controller":
+        if text == "controller":
+            exit_requested.set ()
             sys.exit ()
 
 client = mqtt.Client (client_id='controller', clean_session=True, userdata=None, protocol=mqtt.MQTTv31)
 client.on_connect = on_connect
 client.on_message = on_message
 
+if embed_broker:
+    import mqttbroker
+    broker = mqttbroker.mqtt_broker ()
+    broker.start_in_thread ('0.0.0.0', mqtt_server_port, embed_websocket_port, embed_http_dir)
+    mqtt_server_host = "127.0.0.1"
+
 client.connect (mqtt_server_host, mqtt_server_port, 60)
-client.loop_forever ()
+if fleet_mode:
+    client.loop_start ()
+    while not exit_requested.wait (fleet_view_interval):
+        view = aggregator.view ()
+        print ("fleet: %d cars, %d active, %d telemetry messages missed" % (view['count'], view['active'], view['missed']))
+        client.publish (fleet.addr_fleet_view, json.dumps (view), retain=True)
+    client.loop_stop ()
+else:
+    client.loop_forever ()
@@ -0,0 +1,197 @@
+# Several cars sharing one controller and broker
+#
+# In a fleet, each car has a name and its own topic namespace: its car/... and dash/... topics are under
+# /wifi-py-rpi-car-controller/fleet/<name>/ (e.g., .../fleet/red/car/XY), while the system/... topics stay shared. The
+# controller subscribes to every car's position and telemetry with wildcards, and fleet_aggregator keeps the latest
+# state of every car in preallocated arrays - one array per field, one slot per car - so that a message costs a dict
+# lookup (the topic is only parsed the first time it is seen) and a few stores, however many cars there are. The
+# arrays are the standard library's array.array by default; numpy arrays (bNumpy=True) hold the same, but are slower to
+# store single values in, and bench/bench_fleet.py finds no gain from them in the combined view even with thousands of
+# cars. The combined view is a column per field, rather than an object per car, which is cheaper both to build and to
+# parse.
+#
+#   aggregator = fleet_aggregator ()
+#   client.subscribe (fleet_topic (fleet_any, 'car/XY'))
+#   client.subscribe (fleet_topic (fleet_any, 'car/telemetry'))
+#   ... in on_message: aggregator.message (msg.topic, msg.payload)
+#   ... now and then:  client.publish (addr_fleet_view, json.dumps (aggregator.view ()), retain=True)
+
+import json
+import time
+import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import xycodec
+
+fleet_root = "/wifi-py-rpi-car-controller"
+fleet_any = '+' # a topic filter level matching every car's name
+addr_fleet_view = fleet_root + "/fleet/view" # JSON: the combined view; retained
+
+fleet_fields = ('x', 'y', 't_position', 't_seen', 'sequence', 'missed', 'messages', 'interval')
+
+def fleet_topic (name, subtopic):
+    # subtopic (e.g., 'car/XY') in the namespace of the car called name
+    return fleet_root + '/fleet/' + name + '/' + subtopic
+
+def fleet_namespace (topic, name):
+    # moves one of the single-car topics (e.g., /wifi-py-rpi-car-controller/car/XY) into the car's namespace
+    if name is None or not topic.startswith (fleet_root + '/'):
+        return topic
+    return fleet_topic (name, topic[len (fleet_root)+1:])
+
+def fleet_client_id (name):
+    if name is None:
+        return 'car'
+    return 'car-' + name
+
+class fleet_aggregator (object):
+    # The latest position and telemetry of every car, in arrays indexed by slot
+
+    def __init__ (self, capacity=16, stale_after=2.0, bNumpy=False):
+        self.bNumpy = bNumpy and numpy is not None
+        self.capacity = 0
+        self.count = 0         # cars seen so far; slots 0 to count-1 are in use
+        self.names = []        # slot -> name
+        self.slots = {}        # name -> slot
+        self.routes = {}       # topic -> (slot, kind), for topics seen before
+        self.stale_after = stale_after # a car not heard from for this many seconds isn't counted as active
+        self.fields = {}       # field name -> array
+        self.grow (capacity)
+        self.received = 0
+        self.ignored = 0       # messages on topics that aren't a car's position or telemetry, or that didn't decode
+        return
+
+    def grow (self, capacity):
+        # reallocates every field's array with room for capacity cars
+        for field in fleet_fields:
+            old = self.fields.get (field)
+            if self.bNumpy:
+                new = numpy.zeros (capacity, 'float64')
+                if old is not None:
+                    new[0:self.count] = old[0:self.count]
+            else:
+                new = array.array ('d', [0.0]) * capacity
+                if old is not None:
+                    new[0:self.count] = old[0:self.count]
+            self.fields[field] = new
+        self.capacity = capacity
+        self.x = self.fields['x']
+        self.y = self.fields['y']
+        self.t_position = self.fields['t_position']
+        self.t_seen = self.fields['t_seen']
+        self.sequence = self.fields['sequence']
+        self.missed = self.fields['missed']
+        self.messages = self.fields['messages']
+        self.interval = self.fields['interval']
+        return
+
+    def slot (self, name):
+        slot = self.slots.get (name)
+        if slot is None:
+            if self.count == self.capacity:
+                self.grow (max (16, 2 * self.capacity))
+            slot = self.count
+            self.count += 1
+            self.slots[name] = slot
+            self.names.append (name)
+            self.sequence[slot] = -1
+        return slot
+
+    def route (self, topic):
+        # (slot, kind) for a topic of the form <fleet_root>/fleet/<name>/<kind>, or None
+        prefix = fleet_root + '/fleet/'
+        if not topic.startswith (prefix):
+            return None
+        rest = topic[len (prefix):].split ('/', 1)
+        if len (rest) != 2 or rest[1] not in ('car/XY', 'car/telemetry', 'car/telemetry/snapshot'):
+            return None
+        entry = (self.slot (rest[0]), rest[1])
+        self.routes[topic] = entry
+        return entry
+
+    def message (self, topic, payload, now=None):
+        # from on_message; returns False if the message wasn't one of ours
+        entry = self.routes.get (topic)
+        if entry is None:
+            entry = self.route (topic)
+            if entry is None:
+                self.ignored += 1
+                return False
+        if now is None:
+            now = time.time ()
+        slot, kind = entry
+        if kind == 'car/XY':
+            try:
+                x, y, sequence, t = xycodec.xy_decode (payload)
+            except ValueError:
+                self.ignored += 1
+                return False
+            self.x[slot] = x
+            self.y[slot] = y
+            if t is not None:
+                self.t_position[slot] = t
+        else:
+            try:
+                fields = json.loads (payload)
+            except ValueError:
+                self.ignored += 1
+                return False
+            self.telemetry (slot, fields, kind == 'car/telemetry')
+        self.t_seen[slot] = now
+        self.messages[slot] += 1
+        self.received += 1
+        return True
+
+    def telemetry (self, slot, fields, bDelta):
+        sequence = fields.get ('seq')
+        if sequence is not None:
+            last = self.sequence[slot]
+            if bDelta and last >= 0 and sequence > last + 1: # deltas we never saw
+                self.missed[slot] += sequence - last - 1
+            if sequence > last:
+                self.sequence[slot] = sequence
+        position = fields.get ('position')
+        if position is not None:
+            self.x[slot] = position[0]
+            self.y[slot] = position[1]
+            self.t_position[slot] = fields.get ('t', self.t_position[slot])
+        interval = fields.get ('interval')
+        if interval is not None:
+            self.interval[slot] = interval
+        return
+
+    def ages (self, now):
+        # seconds since each car was last heard from
+        n = self.count
+        if self.bNumpy:
+            return now - self.t_seen[0:n]
+        return [now - t for t in self.t_seen[0:n]]
+
+    def view (self, now=None):
+        # the combined view of the fleet, as a dict for JSON: totals, and a list per field in slot order (see 'names')
+        if now is None:
+            now = time.time ()
+        n = self.count
+        ages = self.ages (now)
+        if self.bNumpy:
+            active = int ((ages < self.stale_after).sum ())
+            ages = ages.tolist ()
+        else:
+            active = len ([age for age in ages if age < self.stale_after])
+        missed = [int (m) for m in self.missed[0:n]]
+        return { 't': now, 'count': n, 'active': active, 'missed': sum (missed), 'names': list (self.names),
+                 'x': self.x[0:n].tolist (), 'y': self.y[0:n].tolist (), 'age': ages,
+                 'seq': [int (sequence) for sequence in self.sequence[0:n]], 'missed_by_car': missed,
+                 'interval': self.interval[0:n].tolist () }
+
+    def counters (self):
+        size = 0
+        for field in fleet_fields:
+            values = self.fields[field]
+            size += values.itemsize * len (values)
+        return { 'cars': self.count, 'capacity': self.capacity, 'received': self.received, 'ignored': self.ignored,
+                 'bytes': size, 'numpy': self.bNumpy }
@@ -0,0 +1,566 @@
+# A small MQTT broker on asyncio (Python 3)
+#
+# Enough of MQTT 3.1 / 3.1.1 for this project's clients: CONNECT (with a last will), PUBLISH (QoS 0, 1 and 2 in;
+# delivered at QoS 0), SUBSCRIBE and UNSUBSCRIBE with + and # wildcards, retained messages, PINGREQ and DISCONNECT.
+# There is no persistence and no authentication, so it is for a trusted local network, tests and benchmarks.
+# Each message is encoded once (a QoS 0 PUBLISH is passed on as it arrived) and the same bytes are handed to every
+# subscriber's transport; a subscriber that isn't keeping up (more than max_backlog bytes waiting to be sent) misses
+# messages rather than holding up the others.
+#
+# MQTT over websockets, for the dashboard (mqtt/dash.js, with the Paho Javascript client), can be served on a second
+# port, which also serves the dashboard's files over HTTP - as mosquitto does with its http_dir option - so that the
+# controller Pi needs nothing else. controller.py can run the broker in its own process (see embed_broker there), or:
+#
+#   python3 mqttbroker.py --port 1883 --websocket-port 9001 --http-dir ../mqtt
+#
+#   broker = mqtt_broker ()
+#   port = broker.start_in_thread ('127.0.0.1', 0) # or: await broker.serve (host, port) on your own event loop
+
+import os
+import sys
+import base64
+import struct
+import asyncio
+import hashlib
+import argparse
+import mimetypes
+import threading
+
+mqtt_CONNECT     = 1
+mqtt_CONNACK     = 2
+mqtt_PUBLISH     = 3
+mqtt_PUBACK      = 4
+mqtt_PUBREC      = 5
+mqtt_PUBREL      = 6
+mqtt_PUBCOMP     = 7
+mqtt_SUBSCRIBE   = 8
+mqtt_SUBACK      = 9
+mqtt_UNSUBSCRIBE = 10
+mqtt_UNSUBACK    = 11
+mqtt_PINGREQ     = 12
+mqtt_PINGRESP    = 13
+mqtt_DISCONNECT  = 14
+
+def mqtt_length (n):
+    # the variable-length 'remaining length' field
+    encoded = bytearray ()
+    while True:
+        byte = n % 128
+        n = n // 128
+        if n > 0:
+            byte |= 0x80
+        encoded.append (byte)
+        if n == 0:
+            return bytes (encoded)
+
+def mqtt_packet (packet_type, flags, body):
+    return bytes (bytearray ([(packet_type << 4) | flags])) + mqtt_length (len (body)) + body
+
+def mqtt_publish_packet (topic, payload, retain=False):
+    # topic and payload as bytes; QoS 0
+    return mqtt_packet (mqtt_PUBLISH, 1 if retain else 0, struct.pack ('!H', len (topic)) + topic + payload)
+
+ws_guid = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+ws_protocols = ['mqtt', 'mqttv3.1'] # MQTT 3.1.1 and 3.1, as the Paho Javascript client asks for them
+ws_max_frame = 1024 * 1024
+
+def ws_frame (payload, opcode=2):
+    # a websocket frame from the server (unmasked); binary by default
+    n = len (payload)
+    if n < 126:
+        header = struct.pack ('!BB', 0x80 | opcode, n)
+    elif n < 65536:
+        header = struct.pack ('!BBH', 0x80 | opcode, 126, n)
+    else:
+        header = struct.pack ('!BBQ', 0x80 | opcode, 127, n)
+    return header + payload
+
+def ws_unmask (data, mask):
+    # XOR with the client's 4-byte mask, all at once as integers
+    n = len (data)
+    key = int.from_bytes ((mask * (n // 4 + 1))[0:n], 'big')
+    return (int.from_bytes (data, 'big') ^ key).to_bytes (n, 'big')
+
+async def ws_pump (reader, writer, stream):
+    # unwraps the frames from a websocket client into stream (an asyncio.StreamReader), as MQTT packets may be split
+    # across frames, or several sent in one; answers pings and closes
+    try:
+        while True:
+            head = await reader.readexactly (2)
+            opcode = head[0] & 0x0f
+            n = head[1] & 0x7f
+            if n == 126:
+                n = struct.unpack ('!H', await reader.readexactly (2))[0]
+            elif n == 127:
+                n = struct.unpack ('!Q', await reader.readexactly (8))[0]
+            if n > ws_max_frame:
+                break
+            mask = None
+            if head[1] & 0x80:
+                mask = await reader.readexactly (4)
+            data = b''
+            if n > 0:
+                data = await reader.readexactly (n)
+                if mask is not None:
+                    data = ws_unmask (data, mask)
+            if opcode in (0, 1, 2): # continuation, text, binary
+                stream.feed_data (data)
+            elif opcode == 8:   # close
+                writer.write (ws_frame (data[0:2], 8))
+                break
+            elif opcode == 9:   # ping
+                writer.write (ws_frame (data, 10))
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    stream.feed_eof ()
+    return
+
+def mqtt_matches (topic_filter, topic):
+    # both as lists of levels; + matches one level, # the rest (including none)
+    n = len (topic_filter)
+    for i in range (0, n):
+        level = topic_filter[i]
+        if level == '#':
+            return True
+        if i >= len (topic):
+            return False
+        if level != '+' and level != topic[i]:
+            return False
+    return n == len (topic)
+
+async def mqtt_read_packet (reader):
+    # returns (packet type, flags, body) from an asyncio StreamReader
+    header = await reader.readexactly (1)
+    length = 0
+    multiplier = 1
+    while True:
+        byte = (await reader.readexactly (1))[0]
+        length += (byte & 0x7f) * multiplier
+        if not (byte & 0x80):
+            break
+        multiplier *= 128
+        if multiplier > 128 ** 3:
+            raise ValueError ('malformed remaining length')
+    body = b''
+    if length > 0:
+        body = await reader.readexactly (length)
+    return header[0] >> 4, header[0] & 0x0f, body
+
+class mqtt_reader (object):
+    # reads fields from the body of a packet
+    def __init__ (self, body):
+        self.body = body
+        self.offset = 0
+        return
+
+    def short (self):
+        value = struct.unpack_from ('!H', self.body, self.offset)[0]
+        self.offset += 2
+        return value
+
+    def byte (self):
+        value = self.body[self.offset]
+        self.offset += 1
+        return value
+
+    def bytes (self):
+        n = self.short ()
+        value = self.body[self.offset:self.offset+n]
+        self.offset += n
+        return value
+
+    def string (self):
+        return self.bytes ().decode ('utf-8')
+
+    def rest (self):
+        return self.body[self.offset:]
+
+    def more (self):
+        return self.offset < len (self.body)
+
+class mqtt_session (object):
+    def __init__ (self, broker, reader, writer, bWebSocket=False):
+        self.broker = broker
+        self.reader = reader
+        self.writer = writer
+        self.bWebSocket = bWebSocket # if so, everything sent goes in websocket frames
+        self.client_id = None
+        self.subscriptions = set () # topic filters
+        self.will = None # (topic, payload, retain)
+        self.keepalive = 0
+        self.missed = 0 # messages not sent because the client wasn't keeping up
+        return
+
+    def send (self, packet, framed=None):
+        # framed, if given, is packet already in a websocket frame
+        transport = self.writer.transport
+        if transport.is_closing ():
+            return False
+        if transport.get_write_buffer_size () > self.broker.max_backlog:
+            self.missed += 1
+            self.broker.missed += 1
+            return False
+        if self.bWebSocket:
+            if framed is None:
+                framed = ws_frame (packet)
+            packet = framed
+        self.writer.write (packet)
+        return True
+
+    async def run (self):
+        try:
+            packet_type, flags, body = await asyncio.wait_for (mqtt_read_packet (self.reader), 10)
+            if packet_type != mqtt_CONNECT:
+                return
+            self.connect (body)
+            while True:
+                if self.keepalive > 0:
+                    packet = await asyncio.wait_for (mqtt_read_packet (self.reader), 1.5 * self.keepalive)
+                else:
+                    packet = await mqtt_read_packet (self.reader)
+                if not self.handle (*packet):
+                    self.will = None # a clean disconnection
+                    break
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError, ValueError, IndexError,
+                struct.error, UnicodeDecodeError):
+            pass
+        finally:
+            self.broker.disconnected (self)
+            self.writer.close ()
+        return
+
+    def connect (self, body):
+        r = mqtt_reader (body)
+        r.string () # protocol name: MQIsdp (3.1) or MQTT (3.1.1)
+        r.byte ()   # protocol level
+        flags = r.byte ()
+        self.keepalive = r.short ()
+        self.client_id = r.string ()
+        if flags & 0x04:
+            topic = r.bytes ()
+            payload = r.bytes ()
+            self.will = (topic, payload, bool (flags & 0x20))
+        self.broker.connected (self)
+        self.send (mqtt_packet (mqtt_CONNACK, 0, b'\x00\x00'))
+        return
+
+    def handle (self, packet_type, flags, body):
+        # returns False on DISCONNECT
+        if packet_type == mqtt_PUBLISH:
+            qos = (flags >> 1) & 3
+            r = mqtt_reader (body)
+            topic = r.bytes ()
+            packet_id = None
+            packet = None
+            if qos > 0:
+                packet_id = r.short ()
+            elif not flags & 1: # not retained, so it goes out just as it came in
+                packet = b''.join ([b'\x30', mqtt_length (len (body)), body])
+            self.broker.publish (topic, r.rest (), bool (flags & 1), packet)
+            if qos == 1:
+                self.send (mqtt_packet (mqtt_PUBACK, 0, struct.pack ('!H', packet_id)))
+            elif qos == 2:
+                self.send (mqtt_packet (mqtt_PUBREC, 0, struct.pack ('!H', packet_id)))
+
+        elif packet_type == mqtt_PUBREL:
+            self.send (mqtt_packet (mqtt_PUBCOMP, 0, body[0:2]))
+
+        elif packet_type == mqtt_SUBSCRIBE:
+            r = mqtt_reader (body)
+            packet_id = r.short ()
+            granted = bytearray ()
+            topic_filters = []
+            while r.more ():
+                topic_filter = r.string ()
+                r.byte () # requested QoS; everything is delivered at QoS 0
+                topic_filters.append (topic_filter)
+                granted.append (0)
+            self.broker.subscribe (self, topic_filters)
+            self.send (mqtt_packet (mqtt_SUBACK, 0, struct.pack ('!H', packet_id) + bytes (granted)))
+            self.broker.send_retained (self, topic_filters)
+
+        elif packet_type == mqtt_UNSUBSCRIBE:
+            r = mqtt_reader (body)
+            packet_id = r.short ()
+            topic_filters = []
+            while r.more ():
+                topic_filters.append (r.string ())
+            self.broker.unsubscribe (self, topic_filters)
+            self.send (mqtt_packet (mqtt_UNSUBACK, 0, struct.pack ('!H', packet_id)))
+
+        elif packet_type == mqtt_PINGREQ:
+            self.send (mqtt_packet (mqtt_PINGRESP, 0, b''))
+
+        elif packet_type == mqtt_DISCONNECT:
+            return False
+
+        return True
+
+class mqtt_broker (object):
+    def __init__ (self, max_backlog=256*1024):
+        self.max_backlog = max_backlog
+        self.sessions = {} # client_id -> mqtt_session
+        self.exact = {}    # topic filter without wildcards -> set of sessions
+        self.wild = {}     # topic filter with wildcards -> (levels, set of sessions)
+        self.retained = {} # topic (bytes) -> publish packet
+        self.websockets = 0 # sessions over websockets
+        self.loop = None
+        self.server = None
+        self.websocket_server = None
+        self.http_dir = None
+        self.received = 0  # messages published to us
+        self.delivered = 0 # messages sent on to subscribers
+        self.missed = 0    # messages not sent to subscribers that weren't keeping up
+        return
+
+    async def serve (self, host='0.0.0.0', port=1883):
+        # starts listening on the running event loop; returns the asyncio server
+        self.loop = asyncio.get_event_loop ()
+        self.server = await asyncio.start_server (self.accept, host, port)
+        return self.server
+
+    async def serve_websocket (self, host='0.0.0.0', port=9001, http_dir=None):
+        # MQTT over websockets, on the running event loop; other HTTP GET requests are for files in http_dir
+        self.loop = asyncio.get_event_loop ()
+        self.http_dir = http_dir
+        self.websocket_server = await asyncio.start_server (self.accept_http, host, port)
+        return self.websocket_server
+
+    def port (self):
+        return self.server.sockets[0].getsockname ()[1]
+
+    def websocket_port (self):
+        return self.websocket_server.sockets[0].getsockname ()[1]
+
+    def start_in_thread (self, host='127.0.0.1', port=0, websocket_port=None, http_dir=None):
+        # runs the broker on an event loop of its own, on a daemon thread; returns the port it is listening on, or
+        # raises whatever stopped it listening (e.g., OSError if the port is already in use)
+        started = threading.Event ()
+        failure = []
+
+        def run ():
+            loop = asyncio.new_event_loop ()
+            asyncio.set_event_loop (loop)
+            try:
+                loop.run_until_complete (self.serve (host, port))
+                if websocket_port is not None:
+                    loop.run_until_complete (self.serve_websocket (host, websocket_port, http_dir))
+            except Exception as e:
+                failure.append (e)
+                if self.server is not None:
+                    self.server.close ()
+                loop.close ()
+                return
+            finally:
+                started.set ()
+            loop.run_forever ()
+
+        thread = threading.Thread (target=run, name='mqtt-broker')
+        thread.daemon = True
+        thread.start ()
+        started.wait ()
+        if failure:
+            raise failure[0]
+        return self.port ()
+
+    def stop (self):
+        # from any thread
+        def close ():
+            self.server.close ()
+            if self.websocket_server is not None:
+                self.websocket_server.close ()
+            for session in list (self.sessions.values ()):
+                session.writer.close ()
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe (close)
+        return
+
+    async def accept (self, reader, writer):
+        await mqtt_session (self, reader, writer).run ()
+        return
+
+    async def accept_http (self, reader, writer):
+        try:
+            request = await asyncio.wait_for (reader.readuntil (b'\r\n\r\n'), 10)
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+            writer.close ()
+            return
+        lines = request.decode ('latin-1').split ('\r\n')
+        words = lines[0].split ()
+        headers = {}
+        for line in lines[1:]:
+            if ':' in line:
+                name, value = line.split (':', 1)
+                headers[name.strip ().lower ()] = value.strip ()
+        if len (words) < 2 or words[0] != 'GET':
+            self.http_respond (writer, '405 Method Not Allowed')
+        elif 'websocket' in headers.get ('upgrade', '').lower () and 'sec-websocket-key' in headers:
+            await self.accept_websocket (reader, writer, headers)
+            return
+        else:
+            self.http_file (writer, words[1])
+        writer.close ()
+        return
+
+    async def accept_websocket (self, reader, writer, headers):
+        key = headers['sec-websocket-key'].encode ('ascii')
+        accept = base64.b64encode (hashlib.sha1 (key + ws_guid).digest ()).decode ('ascii')
+        response = ['HTTP/1.1 101 Switching Protocols', 'Upgrade: websocket', 'Connection: Upgrade',
+                    'Sec-WebSocket-Accept: ' + accept]
+        requested = [p.strip () for p in headers.get ('sec-websocket-protocol', '').split (',')]
+        for protocol in requested:
+            if protocol in ws_protocols:
+                response.append ('Sec-WebSocket-Protocol: ' + protocol)
+                break
+        writer.write (('\r\n'.join (response) + '\r\n\r\n').encode ('latin-1'))
+
+        stream = asyncio.StreamReader ()
+        pump = asyncio.ensure_future (ws_pump (reader, writer, stream))
+        self.websockets += 1
+        try:
+            await mqtt_session (self, stream, writer, True).run ()
+        finally:
+            self.websockets -= 1
+            pump.cancel ()
+        return
+
+    def http_respond (self, writer, status, content_type='text/plain', body=None):
+        if body is None:
+            body = status.encode ('latin-1')
+        head = ['HTTP/1.1 ' + status, 'Content-Type: ' + content_type, 'Content-Length: ' + str (len (body)),
+                'Connection: close']
+        writer.write (('\r\n'.join (head) + '\r\n\r\n').encode ('latin-1') + body)
+        return
+
+    def http_file (self, writer, target):
+        if self.http_dir is None:
+            self.http_respond (writer, '404 Not Found')
+            return
+        path = target.split ('?', 1)[0]
+        if path.endswith ('/'):
+            path += 'index.html'
+        root = os.path.realpath (self.http_dir)
+        filename = os.path.realpath (os.path.join (root, path.lstrip ('/')))
+        if not filename.startswith (root + os.sep) or not os.path.isfile (filename): # nothing outside http_dir
+            self.http_respond (writer, '404 Not Found')
+            return
+        with open (filename, 'rb') as f:
+            body = f.read ()
+        content_type = mimetypes.guess_type (filename)[0] or 'application/octet-stream'
+        self.http_respond (writer, '200 OK', content_type, body)
+        return
+
+    def connected (self, session):
+        old = self.sessions.get (session.client_id)
+        if old is not None: # a client ID may only be connected once
+            old.will = None
+            self.disconnected (old)
+            old.writer.close ()
+        if session.client_id:
+            self.sessions[session.client_id] = session
+        return
+
+    def disconnected (self, session):
+        if self.sessions.get (session.client_id) is session:
+            del self.sessions[session.client_id]
+        self.unsubscribe (session, list (session.subscriptions))
+        if session.will is not None:
+            topic, payload, retain = session.will
+            session.will = None
+            self.publish (topic, payload, retain)
+        return
+
+    def subscribe (self, session, topic_filters):
+        for topic_filter in topic_filters:
+            session.subscriptions.add (topic_filter)
+            if '+' in topic_filter or '#' in topic_filter:
+                entry = self.wild.get (topic_filter)
+                if entry is None:
+                    entry = (topic_filter.split ('/'), set ())
+                    self.wild[topic_filter] = entry
+                entry[1].add (session)
+            else:
+                self.exact.setdefault (topic_filter, set ()).add (session)
+        return
+
+    def unsubscribe (self, session, topic_filters):
+        for topic_filter in topic_filters:
+            session.subscriptions.discard (topic_filter)
+            sessions = self.exact.get (topic_filter)
+            if sessions is None:
+                entry = self.wild.get (topic_filter)
+                if entry is None:
+                    continue
+                sessions = entry[1]
+                sessions.discard (session)
+                if not sessions:
+                    del self.wild[topic_filter]
+            else:
+                sessions.discard (session)
+                if not sessions:
+                    del self.exact[topic_filter]
+        return
+
+    def subscribers (self, topic):
+        # the sessions subscribed to topic (a str)
+        sessions = set (self.exact.get (topic, ()))
+        if self.wild:
+            levels = topic.split ('/')
+            for topic_filter in self.wild:
+                entry = self.wild[topic_filter]
+                if mqtt_matches (entry[0], levels):
+                    sessions |= entry[1]
+        return sessions
+
+    def publish (self, topic, payload, retain=False, packet=None):
+        # topic and payload as bytes; packet, if given, is the QoS 0 PUBLISH for them
+        self.received += 1
+        if retain:
+            if payload:
+                self.retained[topic] = mqtt_publish_packet (topic, payload, True)
+            else:
+                self.retained.pop (topic, None)
+        sessions = self.subscribers (topic.decode ('utf-8'))
+        if not sessions:
+            return
+        if packet is None:
+            packet = mqtt_publish_packet (topic, payload)
+        framed = None
+        if self.websockets > 0:
+            framed = ws_frame (packet)
+        for session in sessions:
+            if session.send (packet, framed): # the same bytes for everyone
+                self.delivered += 1
+        return
+
+    def send_retained (self, session, topic_filters):
+        for topic in list (self.retained):
+            levels = topic.decode ('utf-8').split ('/')
+            for topic_filter in topic_filters:
+                if mqtt_matches (topic_filter.split ('/'), levels):
+                    session.send (self.retained[topic])
+                    break
+        return
+
+    def counters (self):
+        return { 'sessions': len (self.sessions), 'websockets': self.websockets, 'retained': len (self.retained),
+                 'received': self.received, 'delivered': self.delivered, 'missed': self.missed }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser (description='A small MQTT broker, with MQTT over websockets for the dashboard.')
+    parser.add_argument ('--host', default='0.0.0.0', help='address to listen on')
+    parser.add_argument ('--port', type=int, default=1883, help='MQTT port')
+    parser.add_argument ('--websocket-port', type=int, default=None, help='MQTT over websockets (and HTTP) port')
+    parser.add_argument ('--http-dir', default=None, help='files to serve over HTTP on the websocket port')
+    args = parser.parse_args ()
+
+    broker = mqtt_broker ()
+    loop = asyncio.new_event_loop ()
+    asyncio.set_event_loop (loop)
+    loop.run_until_complete (broker.serve (args.host, args.port))
+    if args.websocket_port is not None:
+        loop.run_until_complete (broker.serve_websocket (args.host, args.websocket_port, args.http_dir))
+    try:
+        loop.run_forever ()
+    except KeyboardInterrupt:
+        sys.exit (0)
@@ -0,0 +1,257 @@
+# Outbound MQTT messages for car.py, so that tock () never waits on the MQTT client
+#
+# publish () only adds the message to a bounded queue and returns. The client's network loop hands everything waiting
+# over to the client in one batch: with the threaded controller, that loop is a thread of ours which takes the place
+# of client.loop_start ()'s, so that the batch is written to the socket there and then, with no further hand-off (and
+# which, like loop_start (), reconnects if the connection is lost); with the asyncio controller, it is a callback on
+# the event loop, where paho is driven. A message for a topic that already has one waiting replaces it, unless it is
+# marked as not superseding (e.g., telemetry deltas, which must all be delivered); if the queue is full, the oldest
+# message is dropped. Latency is measured from publish () to the client accepting the message, and to the client
+# writing it to the network (via on_publish).
+
+import select
+import socket
+import threading
+import itertools
+
+from collections import OrderedDict
+
+from ticktock import qClock, qHistogram
+
+publish_flight_max = 1000 # messages awaiting on_publish, before we assume they never will
+
+class publish_pipeline (object):
+    def __init__ (self, capacity=64, reconnect_min=1.0, reconnect_max=120.0):
+        self.capacity = capacity
+        self.reconnect_min = reconnect_min # threaded: seconds to wait before reconnecting at first, doubling up to
+        self.reconnect_max = reconnect_max # reconnect_max while it keeps failing
+        self.cv = threading.Condition ()
+        self.pending = OrderedDict () # topic (or a unique key) -> (topic, payload, retain, t_queued)
+        self.unique = itertools.count ()
+        self.client = None
+        self.loop = None
+        self.bScheduled = False # a drain () is due on the loop, or the network thread has been woken
+        self.bRunning = False
+        self.thread = None
+        self.wake_r = None # threaded: written to wake the network thread from select ()
+        self.wake_w = None
+
+        self.lock = threading.Lock () # for the counters and in_flight; never held while calling the client
+        self.in_flight = {} # mid -> t_queued, until on_publish
+        self.early = {}     # mid -> t_sent, for on_publish calls that beat us to in_flight
+        self.handoff = qHistogram () # publish () to client.publish () returning
+        self.sent = qHistogram ()    # publish () to on_publish
+        self.queued = 0
+        self.superseded = 0
+        self.dropped = 0
+        self.published = 0
+        self.errors = 0
+        self.batches = 0
+        self.reconnects = 0
+        return
+
+    def start (self, client, loop=None):
+        # with loop, the messages are handed over on that asyncio event loop (which drives the client); otherwise on a
+        # thread of our own, which drives the client in place of client.loop_start () - call one or the other, after
+        # client.connect (), and stop () before client.disconnect ()
+        self.client = client
+        self.loop = loop
+        client.on_publish = self.on_publish
+        if loop is not None:
+            with self.cv:
+                if self.pending:
+                    self.schedule ()
+            return
+        self.wake_r, self.wake_w = socket.socketpair ()
+        self.wake_r.setblocking (False)
+        self.wake_w.setblocking (False)
+        with self.cv:
+            self.bRunning = True
+            self.bScheduled = False
+        self.thread = threading.Thread (target=self.run, name='mqtt')
+        self.thread.daemon = True
+        self.thread.start ()
+        return
+
+    def stop (self):
+        with self.cv:
+            self.bRunning = False
+            self.wake ()
+        if self.thread is not None:
+            self.thread.join ()
+            self.thread = None
+            with self.cv:
+                self.wake_r.close ()
+                self.wake_w.close ()
+                self.wake_r = None
+                self.wake_w = None
+        return
+
+    def publish (self, topic, payload, retain=False, bSupersede=True):
+        # never waits; returns False if an older message had to be dropped to make room
+        bRoom = True
+        with self.cv:
+            key = topic
+            if not bSupersede:
+                key = (topic, next (self.unique))
+            if key in self.pending:
+                self.superseded += 1
+                del self.pending[key] # the replacement goes to the back of the queue
+            elif self.capacity > 0 and len (self.pending) >= self.capacity:
+                self.pending.popitem (False)
+                self.dropped += 1
+                bRoom = False
+            self.pending[key] = (topic, payload, retain, qClock ())
+            self.queued += 1
+            if self.loop is not None:
+                self.schedule ()
+            elif not self.bScheduled:
+                self.bScheduled = True
+                self.wake ()
+        return bRoom
+
+    def schedule (self):
+        # with self.cv held
+        if not self.bScheduled:
+            self.bScheduled = True
+            self.loop.call_soon_threadsafe (self.drain)
+        return
+
+    def wake (self):
+        # with self.cv held
+        if self.wake_w is not None:
+            try:
+                self.wake_w.send (b'x')
+            except socket.error: # full, so the thread will wake anyway
+                pass
+        return
+
+    def take (self):
+        # with self.cv held
+        batch = list (self.pending.values ())
+        self.pending = OrderedDict ()
+        return batch
+
+    def run (self):
+        # threaded: the client's network loop, as in loop_start ()'s thread, but handing over each batch on the way
+        client = self.client
+        delay = self.reconnect_min
+        while True:
+            sock = client.socket ()
+            if sock is None: # the connection was lost (e.g., the broker restarted, or the WiFi dropped)
+                if not self.pause (delay):
+                    break
+                self.reconnects += 1
+                try:
+                    client.reconnect () # a blocking connect, as in loop_start ()'s thread; on_connect resubscribes
+                    delay = self.reconnect_min
+                except (socket.error, OSError, ValueError): # not back yet; try again later
+                    delay = min (2 * delay, self.reconnect_max)
+                continue
+
+            with self.cv:
+                if not self.bRunning:
+                    break
+                self.bScheduled = False
+                batch = self.take ()
+            if batch:
+                self.send (batch) # with no loop_start () thread, the client writes to the socket straight away
+
+            writers = []
+            if client.want_write ():
+                writers = [sock]
+            bPending = hasattr (sock, 'pending') and sock.pending () > 0 # TLS data already read from the socket
+            timeout = 1.0
+            if bPending:
+                timeout = 0
+            readable, writable = self.wait ([sock], writers, timeout)
+            if sock in readable or bPending:
+                client.loop_read ()
+            if sock in writable and client.socket () is sock:
+                client.loop_write ()
+            client.loop_misc () # keepalive pings, and giving up on a connection that has gone quiet
+        return
+
+    def pause (self, seconds):
+        # threaded: waits while disconnected (messages published meanwhile wait in the queue); False once stopped
+        t_end = qClock () + seconds
+        while True:
+            with self.cv:
+                if not self.bRunning:
+                    return False
+            remaining = t_end - qClock ()
+            if remaining <= 0:
+                return True
+            self.wait ([], [], remaining)
+
+    def wait (self, readers, writers, timeout):
+        # threaded: select () on readers and writers as well as the wake-up socket, for up to timeout seconds
+        try:
+            readable, writable, broken = select.select (readers + [self.wake_r], writers, [], timeout)
+        except (select.error, ValueError): # a socket closed under us; the loop will find out
+            return [], []
+        if self.wake_r in readable:
+            try:
+                self.wake_r.recv (4096)
+            except socket.error:
+                pass
+        return readable, writable
+
+    def drain (self):
+        # asyncio: on the event loop
+        with self.cv:
+            self.bScheduled = False
+            batch = self.take ()
+        self.send (batch)
+        return
+
+    def send (self, batch):
+        for topic, payload, retain, t_queued in batch:
+            try:
+                result = self.client.publish (topic, payload, retain=retain)
+                rc, mid = result[0], result[1]
+            except (ValueError, OSError):
+                rc, mid = -1, None
+            now = qClock ()
+            with self.lock:
+                self.handoff.add (now - t_queued)
+                if rc != 0:
+                    self.errors += 1
+                    continue
+                self.published += 1
+                t_sent = self.early.pop (mid, None)
+                if t_sent is None:
+                    if len (self.in_flight) >= publish_flight_max: # lost in a disconnection
+                        self.in_flight.clear ()
+                    self.in_flight[mid] = t_queued
+                else:
+                    self.sent.add (t_sent - t_queued)
+        with self.lock:
+            self.batches += 1
+        return
+
+    def on_publish (self, client, userdata, mid):
+        # paho's network thread (or the event loop), once the message has been written
+        now = qClock ()
+        with self.lock:
+            t_queued = self.in_flight.pop (mid, None)
+            if t_queued is None: # or it wasn't one of ours
+                if len (self.early) >= publish_flight_max:
+                    self.early.clear ()
+                self.early[mid] = now
+            else:
+                self.sent.add (now - t_queued)
+        return
+
+    def counters (self, reset=False):
+        with self.cv:
+            waiting = len (self.pending)
+        with self.lock:
+            c = { 'waiting': waiting, 'queued': self.queued, 'superseded': self.superseded, 'dropped': self.dropped,
+                  'published': self.published, 'errors': self.errors, 'batches': self.batches,
+                  'reconnects': self.reconnects,
+                  'latency': { 'handoff': self.handoff.snapshot (), 'sent': self.sent.snapshot () } }
+            if reset:
+                self.handoff.reset ()
+                self.sent.reset ()
+        return c
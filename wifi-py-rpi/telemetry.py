@@ -0,0 +1,97 @@
+# Change-driven telemetry for car.py
+#
+# Values are set () as often as convenient (e.g., in every tock), but only published when one of them has moved by
+# more than its deadband since it was last published; all the fields that have changed go out together, as one JSON
+# message per flush (). Every message has a sequence number, so that a dashboard can tell if it has missed one. A
+# snapshot of every field is also kept, retained, on a topic of its own, so that a dashboard connecting later gets
+# the current state at once instead of waiting for each field to change; it is republished at most every
+# snapshot_interval seconds, and only if something has changed.
+
+import json
+import time
+
+def telemetry_changed (value, last, deadband):
+    if isinstance (value, bool) or isinstance (last, bool):
+        return value != last
+    if isinstance (value, (int, float)) and isinstance (last, (int, float)):
+        return abs (value - last) > deadband
+    return value != last
+
+class telemetry_publisher (object):
+    def __init__ (self, publish, topic, snapshot_topic, snapshot_interval=1.0):
+        self.publish = publish # publish (topic, payload, retain, bSupersede)
+        self.topic = topic
+        self.snapshot_topic = snapshot_topic
+        self.snapshot_interval = snapshot_interval
+        self.deadbands = {} # name -> deadband
+        self.values = {}    # name -> latest value
+        self.sent = {}      # name -> value last published
+        self.sequence = 0
+        self.t_snapshot = None
+        self.bSnapshotDue = False
+        self.messages = 0   # delta messages published
+        self.snapshots = 0  # snapshots published
+        self.suppressed = 0 # flushes with nothing worth publishing
+        return
+
+    def field (self, name, deadband=0.0):
+        # a number (or list of numbers) is published when any of it moves more than deadband; anything else on change
+        self.deadbands[name] = deadband
+        return
+
+    def set (self, name, value):
+        self.values[name] = value
+        return
+
+    def changed (self, name, value):
+        if name not in self.sent:
+            return True
+        last = self.sent[name]
+        deadband = self.deadbands.get (name, 0.0)
+        if isinstance (value, (list, tuple)) and isinstance (last, (list, tuple)) and len (value) == len (last):
+            for i in range (0, len (value)):
+                if telemetry_changed (value[i], last[i], deadband):
+                    return True
+            return False
+        return telemetry_changed (value, last, deadband)
+
+    def flush (self, now=None):
+        # publishes whatever has changed; returns the fields published (a dict, empty if none)
+        if now is None:
+            now = time.time ()
+        delta = {}
+        for name in self.values:
+            value = self.values[name]
+            if self.changed (name, value):
+                delta[name] = value
+                self.sent[name] = value
+
+        if delta:
+            self.sequence += 1
+            message = dict (delta)
+            message['seq'] = self.sequence
+            message['t'] = now
+            self.publish (self.topic, json.dumps (message), False, False) # every delta matters
+            self.messages += 1
+            self.bSnapshotDue = True
+        else:
+            self.suppressed += 1
+
+        if self.bSnapshotDue and (self.t_snapshot is None or now - self.t_snapshot >= self.snapshot_interval):
+            self.publish_snapshot (now)
+        return delta
+
+    def publish_snapshot (self, now=None):
+        if now is None:
+            now = time.time ()
+        snapshot = dict (self.sent)
+        snapshot['seq'] = self.sequence
+        snapshot['t'] = now
+        self.publish (self.snapshot_topic, json.dumps (snapshot), True, True)
+        self.t_snapshot = now
+        self.bSnapshotDue = False
+        self.snapshots += 1
+        return
+
+    def counters (self):
+        return { 'messages': self.messages, 'snapshots': self.snapshots, 'suppressed': self.suppressed }
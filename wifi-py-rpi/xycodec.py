@@ -0,0 +1,58 @@
+# Payloads for the /car/XY and /dash/XY topics
+#
+# Binary, version 1: little-endian '<BBIdff', 22 bytes - version (1), flags (0), sequence number (uint32, wrapping),
+# timestamp (float64, seconds since the Unix epoch, when sent), x, y (float32, -1 to 1).
+# Text, the original format, which old dashboards send and expect: "x y", each to three decimal places.
+# A payload is binary if its first byte is a version number; text never starts with one, so receivers can always
+# accept both. Which one a sender uses is negotiated (see car.py and mqtt/dash.js): each side announces on its
+# */encoding topic which encodings it can decode, and text is used with anyone who hasn't said.
+
+import time
+import struct
+
+xy_version = 1
+xy_struct = struct.Struct ('<BBIdff')
+
+xy_encoding_text   = 'text'
+xy_encoding_binary = 'xy1'
+xy_encodings = xy_encoding_binary + ' ' + xy_encoding_text # what we can decode, for announcements
+
+def xy_text (x, y):
+    return '%.3f %.3f' % (x, y)
+
+def xy_encode (x, y, sequence=0, t=None):
+    if t is None:
+        t = time.time ()
+    return xy_struct.pack (xy_version, 0, sequence & 0xffffffff, t, x, y)
+
+def xy_decode (payload):
+    # returns (x, y, sequence, t), with sequence and t None for text; raises ValueError if payload is neither
+    if not isinstance (payload, str) or str is bytes: # bytes (or Python 2's str)
+        if len (payload) == xy_struct.size and bytearray (payload[0:1])[0] == xy_version:
+            version, flags, sequence, t, x, y = xy_struct.unpack (payload)
+            return x, y, sequence, t
+        payload = payload.decode ('ascii', 'replace')
+    xy = payload.split ()
+    if len (xy) != 2:
+        raise ValueError ('not an XY payload: ' + repr (payload))
+    return float (xy[0]), float (xy[1]), None, None
+
+def xy_accepts_binary (announcement):
+    # True if an */encoding announcement lists the binary encoding
+    if not isinstance (announcement, str):
+        announcement = announcement.decode ('ascii', 'replace')
+    return xy_encoding_binary in announcement.split ()
+
+class xy_sender (object):
+    # Encodes positions for one sender, in text until told that the other side can decode binary
+
+    def __init__ (self, encoding=xy_encoding_text):
+        self.encoding = encoding
+        self.sequence = 0
+        return
+
+    def encode (self, x, y):
+        if self.encoding == xy_encoding_binary:
+            self.sequence += 1
+            return xy_encode (x, y, self.sequence)
+        return xy_text (x, y)